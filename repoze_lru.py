@@ -7,6 +7,7 @@ from __future__ import with_statement
 import threading
 import time
 import uuid
+from collections import OrderedDict
 
 
 _MARKER = object()
@@ -20,12 +21,18 @@ class LRUCache(object):
 
     The Clock algorithm is not kept strictly to improve performance, e.g. to
     allow get() and invalidate() to work without acquiring the lock.
+
+    If max_bytes is specified, total size of cached values, as computed by
+    sizeof, is kept under max_bytes by evicting more entries.
     """
-    def __init__(self, size):
+    def __init__(self, size, max_bytes=None, sizeof=len):
         size = int(size)
         if size < 1:
             raise ValueError('size must be >0')
         self.size = size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
         self.lock = threading.Lock()
         self.hand = 0
         self.maxpos = size - 1
@@ -52,6 +59,7 @@ class LRUCache(object):
             self.clock_keys = [_MARKER] * size
             self.clock_refs = [False] * size
             self.hand = 0
+            self.total_bytes = 0
             self.evictions = 0
             self.hits = 0
             self.misses = 0
@@ -66,85 +74,414 @@ class LRUCache(object):
         except KeyError:
             self.misses += 1
             return default
-        self.clock_refs[pos] = True
+        try:
+            self.clock_refs[pos] = True
+        except IndexError:
+            # Entry was found just before concurrent resize() shrank cache.
+            pass
         return val
 
     def put(self, key, val):
         """Add key to the cache with value val"""
-        # These do not change or they are just references, no need for locking.
-        maxpos = self.maxpos
+        with self.lock:
+            self._put(key, val)
+
+    def put_many(self, items):
+        """Add (key, val) pairs to the cache, lock is acquired only once"""
+        with self.lock:
+            for key, val in items:
+                self._put(key, val)
+
+    def _put(self, key, val):
+        """Add key to the cache with value val
+
+        Should be called with lock acquired.
+        """
         clock_refs = self.clock_refs
         clock_keys = self.clock_keys
         data = self.data
+        max_bytes = self.max_bytes
+
+        if max_bytes is not None and self.sizeof(val) > max_bytes:
+            # Value will never fit into cache, previous value is stale.
+            entry = data.pop(key, _MARKER)
+            if entry is not _MARKER:
+                self.total_bytes -= self.sizeof(entry[1])
+                clock_refs[entry[0]] = False
+            return
+
+        entry = data.get(key)
+        if entry is not None:
+            # We already have key. Only make sure data is up to date and
+            # to remember that it was used.
+            pos, old_val = entry
+            if old_val is not val:
+                data[key] = (pos, val)
+                if max_bytes is not None:
+                    self.total_bytes += self.sizeof(val) - self.sizeof(old_val)
+            self.clock_refs[pos] = True
+        else:
+            # key is not yet in cache. Search place to insert it.
+
+            hand = self._find_victim()
+            oldkey = clock_keys[hand]
+            # Maybe oldkey was not in self.data to begin with. If it
+            # was, self.invalidate() in another thread might have
+            # already removed it. del() would raise KeyError, so pop().
+            oldentry = data.pop(oldkey, _MARKER)
+            if oldentry is not _MARKER:
+                self.evictions += 1
+                if max_bytes is not None:
+                    self.total_bytes -= self.sizeof(oldentry[1])
+            clock_keys[hand] = key
+            clock_refs[hand] = True
+            data[key] = (hand, val)
+            if max_bytes is not None:
+                self.total_bytes += self.sizeof(val)
+
+        self._shrink(key)
+
+    def _shrink(self, keep_key=_MARKER):
+        """Evict entries until values fit into max_bytes
+
+        Should be called with lock acquired.
+        """
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            return
 
+        clock_keys = self.clock_keys
+        data = self.data
+        while self.total_bytes > max_bytes and data:
+            if len(data) == 1 and keep_key in data:
+                break
+            hand = self._find_victim()
+            oldkey = clock_keys[hand]
+            if oldkey == keep_key:
+                continue
+            oldentry = data.pop(oldkey, _MARKER)
+            if oldentry is not _MARKER:
+                self.evictions += 1
+                self.total_bytes -= self.sizeof(oldentry[1])
+            clock_keys[hand] = _MARKER
+
+    def resize(self, size=None, max_bytes=_MARKER):
+        """Change number of entries and/or max_bytes keeping cached entries
+
+        When cache shrinks entries next to be evicted by the clock are
+        dropped first.
+        """
         with self.lock:
-            entry = data.get(key)
-            if entry is not None:
-                # We already have key. Only make sure data is up to date and
-                # to remember that it was used.
-                pos, old_val = entry
-                if old_val is not val:
-                    data[key] = (pos, val)
-                self.clock_refs[pos] = True
-                return
-            # else: key is not yet in cache. Search place to insert it.
-
-            hand = self.hand
-            count = 0
-            max_count = 107
-            while 1:
-                ref = clock_refs[hand]
-                if ref == True:
+            if size is None:
+                size = self.size
+            size = int(size)
+            if size < 1:
+                raise ValueError('size must be >0')
+            if max_bytes is not _MARKER:
+                self.max_bytes = max_bytes
+
+            # Collect entries in order of their eviction, referenced ones
+            # last.
+            old_size = self.size
+            unreferenced = []
+            referenced = []
+            for i in range(old_size):
+                pos = (self.hand + i) % old_size
+                key = self.clock_keys[pos]
+                entry = self.data.get(key)
+                if entry is not None and entry[0] == pos:
+                    if self.clock_refs[pos]:
+                        referenced.append((key, entry[1]))
+                    else:
+                        unreferenced.append((key, entry[1]))
+            entries = unreferenced + referenced
+            self.evictions += max(0, len(entries) - size)
+            entries = entries[max(0, len(entries) - size):]
+
+            data = {}
+            clock_keys = [_MARKER] * size
+            clock_refs = [False] * size
+            total_bytes = 0
+            for pos, (key, val) in enumerate(entries):
+                data[key] = (pos, val)
+                clock_keys[pos] = key
+                clock_refs[pos] = pos >= len(entries) - len(referenced)
+                if self.max_bytes is not None:
+                    total_bytes += self.sizeof(val)
+
+            self.clock_keys = clock_keys
+            self.clock_refs = clock_refs
+            self.data = data
+            self.size = size
+            self.maxpos = size - 1
+            self.hand = len(entries) % size
+            self.total_bytes = total_bytes
+            self._shrink()
+
+    def _find_victim(self):
+        """Find position of entry to evict and move hand past it
+
+        Should be called with lock acquired.
+        """
+        maxpos = self.maxpos
+        clock_refs = self.clock_refs
+
+        hand = self.hand
+        count = 0
+        max_count = 107
+        while 1:
+            ref = clock_refs[hand]
+            if ref == True:
+                clock_refs[hand] = False
+                hand += 1
+                if hand > maxpos:
+                    hand = 0
+
+                count += 1
+                if count >= max_count:
+                    # We have been searching long enough. Force eviction of
+                    # next entry, no matter what its status is.
                     clock_refs[hand] = False
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-
-                    count += 1
-                    if count >= max_count:
-                        # We have been searching long enough. Force eviction of
-                        # next entry, no matter what its status is.
-                        clock_refs[hand] = False
-                else:
-                    oldkey = clock_keys[hand]
-                    # Maybe oldkey was not in self.data to begin with. If it
-                    # was, self.invalidate() in another thread might have
-                    # already removed it. del() would raise KeyError, so pop().
-                    oldentry = data.pop(oldkey, _MARKER)
-                    if oldentry is not _MARKER:
-                        self.evictions += 1
-                    clock_keys[hand] = key
-                    clock_refs[hand] = True
-                    data[key] = (hand, val)
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-                    self.hand = hand
-                    break
+            else:
+                victim = hand
+                hand += 1
+                if hand > maxpos:
+                    hand = 0
+                self.hand = hand
+                return victim
 
     def invalidate(self, key):
         """Remove key from the cache"""
+        if self.max_bytes is not None:
+            # Keep total size consistent.
+            with self.lock:
+                entry = self.data.pop(key, _MARKER)
+                if entry is not _MARKER:
+                    self.total_bytes -= self.sizeof(entry[1])
+                    self.clock_refs[entry[0]] = False
+            return
+
         # pop with default arg will not raise KeyError
         entry = self.data.pop(key, _MARKER)
         if entry is not _MARKER:
             # We have no lock, but worst thing that can happen is that we
             # set another key's entry to False.
-            self.clock_refs[entry[0]] = False
+            try:
+                self.clock_refs[entry[0]] = False
+            except IndexError:
+                # Cache was shrunk by concurrent resize().
+                pass
         # else: key was not in cache. Nothing to do.
 
 
+class SLRUCache(object):
+    """ Implements segmented LRU algorithm
+
+    New entries are put into probationary segment and are moved into
+    protected segment when they are accessed again. Entries are evicted from
+    probationary segment first, so scan of many entries, each accessed once,
+    doesn't evict frequently used ones.
+
+    Order of entries is updated on every access, so get() acquires the lock.
+
+    If max_bytes is specified, total size of cached values, as computed by
+    sizeof, is kept under max_bytes by evicting more entries.
+    """
+    def __init__(self, size, protected_ratio=0.8, max_bytes=None, sizeof=len):
+        size = int(size)
+        if size < 1:
+            raise ValueError('size must be >0')
+        self.size = size
+        self.protected_ratio = protected_ratio
+        self.protected_size = int(size * protected_ratio)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self.protected_bytes = 0
+        self.lock = threading.Lock()
+        self.probation = None
+        self.protected = None
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.clear()
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self.lock:
+            # Least recently used entries are first.
+            self.probation = OrderedDict()
+            self.protected = OrderedDict()
+            self.total_bytes = 0
+            self.protected_bytes = 0
+            self.evictions = 0
+            self.hits = 0
+            self.misses = 0
+            self.lookups = 0
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default"""
+        with self.lock:
+            self.lookups += 1
+            val = self.protected.pop(key, _MARKER)
+            if val is not _MARKER:
+                self.protected[key] = val
+                self.hits += 1
+                return val
+
+            val = self.probation.pop(key, _MARKER)
+            if val is not _MARKER:
+                # Accessed again, promote.
+                self._protect(key, val)
+                self.hits += 1
+                return val
+
+            self.misses += 1
+            return default
+
+    def _value_size(self, val):
+        if self.max_bytes is None:
+            return 0
+        return self.sizeof(val)
+
+    def _protect(self, key, val):
+        """Put entry into protected segment
+
+        Should be called with lock acquired.
+        """
+        self.protected[key] = val
+        self.protected_bytes += self._value_size(val)
+        self._demote()
+        self._evict()
+
+    def _demote(self):
+        """Move least recently used protected entries to probationary segment
+
+        Demoted entries get one more chance in probationary segment. Should be
+        called with lock acquired.
+        """
+        max_protected_bytes = None
+        if self.max_bytes is not None:
+            max_protected_bytes = self.max_bytes * self.protected_ratio
+        while self.protected and (len(self.protected) > self.protected_size or
+                                  (max_protected_bytes is not None and
+                                   self.protected_bytes > max_protected_bytes)):
+            old_key, old_val = self.protected.popitem(last=False)
+            self.protected_bytes -= self._value_size(old_val)
+            self.probation[old_key] = old_val
+
+    def _evict(self):
+        """Evict entries until cache fits into its size and max_bytes
+
+        Should be called with lock acquired.
+        """
+        while True:
+            count = len(self.probation) + len(self.protected)
+            if count <= self.size and (self.max_bytes is None or self.total_bytes <= self.max_bytes):
+                break
+            if self.probation:
+                old_key, old_val = self.probation.popitem(last=False)
+            else:
+                old_key, old_val = self.protected.popitem(last=False)
+                self.protected_bytes -= self._value_size(old_val)
+            self.total_bytes -= self._value_size(old_val)
+            self.evictions += 1
+
+    def put(self, key, val):
+        """Add key to the cache with value val"""
+        with self.lock:
+            self._put(key, val)
+
+    def put_many(self, items):
+        """Add (key, val) pairs to the cache, lock is acquired only once"""
+        with self.lock:
+            for key, val in items:
+                self._put(key, val)
+
+    def _put(self, key, val):
+        """Add key to the cache with value val
+
+        Should be called with lock acquired.
+        """
+        if self.max_bytes is not None and self.sizeof(val) > self.max_bytes:
+            # Value will never fit into cache, previous value is stale.
+            self._invalidate(key)
+            return
+
+        size = self._value_size(val)
+        if key in self.protected:
+            old_size = self._value_size(self.protected[key])
+            self.protected[key] = val
+            self.protected_bytes += size - old_size
+            self.total_bytes += size - old_size
+            self._demote()
+        elif key in self.probation:
+            self.total_bytes += size - self._value_size(self.probation[key])
+            self.probation[key] = val
+        else:
+            self.probation[key] = val
+            self.total_bytes += size
+        self._evict()
+
+    def resize(self, size=None, max_bytes=_MARKER):
+        """Change number of entries and/or max_bytes keeping cached entries"""
+        with self.lock:
+            if size is None:
+                size = self.size
+            size = int(size)
+            if size < 1:
+                raise ValueError('size must be >0')
+            self.size = size
+            self.protected_size = int(size * self.protected_ratio)
+
+            if max_bytes is not _MARKER and max_bytes != self.max_bytes:
+                self.max_bytes = max_bytes
+                # Sizes are not tracked without max_bytes, recalculate them.
+                self.protected_bytes = sum(self._value_size(val) for val in self.protected.itervalues())
+                self.total_bytes = self.protected_bytes + sum(
+                    self._value_size(val) for val in self.probation.itervalues())
+
+            self._demote()
+            self._evict()
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        with self.lock:
+            self._invalidate(key)
+
+    def _invalidate(self, key):
+        """Remove key from the cache
+
+        Should be called with lock acquired.
+        """
+        val = self.protected.pop(key, _MARKER)
+        if val is not _MARKER:
+            self.protected_bytes -= self._value_size(val)
+        else:
+            val = self.probation.pop(key, _MARKER)
+        if val is not _MARKER:
+            self.total_bytes -= self._value_size(val)
+
+
 class ExpiringLRUCache(object):
     """ Implements a pseudo-LRU algorithm (CLOCK) with expiration times
 
     The Clock algorithm is not kept strictly to improve performance, e.g. to
     allow get() and invalidate() to work without acquiring the lock.
+
+    If max_bytes is specified, total size of cached values, as computed by
+    sizeof, is kept under max_bytes by evicting more entries.
     """
-    def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT):
+    def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT, max_bytes=None, sizeof=len):
         self.default_timeout = default_timeout
         size = int(size)
         if size < 1:
             raise ValueError('size must be >0')
         self.size = size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
         self.lock = threading.Lock()
         self.hand = 0
         self.maxpos = size - 1
@@ -172,6 +509,7 @@ class ExpiringLRUCache(object):
             self.clock_keys = [_MARKER] * size
             self.clock_refs = [False] * size
             self.hand = 0
+            self.total_bytes = 0
             self.evictions = 0
             self.hits = 0
             self.misses = 0
@@ -185,17 +523,33 @@ class ExpiringLRUCache(object):
         except KeyError:
             self.misses += 1
             return default
-        if expires > time.time():
-            # cache entry still valid
-            self.hits += 1
-            self.clock_refs[pos] = True
-            return val
-        else:
-            # cache entry has expired. Make sure the space in the cache can
-            # be recycled soon.
-            self.misses += 1
-            self.clock_refs[pos] = False
+        try:
+            if expires > time.time():
+                # cache entry still valid
+                self.hits += 1
+                self.clock_refs[pos] = True
+                return val
+            else:
+                # cache entry has expired. Make sure the space in the cache
+                # can be recycled soon.
+                self.misses += 1
+                self.clock_refs[pos] = False
+                return default
+        except IndexError:
+            # Entry was found just before concurrent resize() shrank cache.
+            return val if expires > time.time() else default
+
+    def get_stale(self, key, max_staleness, default=None):
+        """Return value for key even if it expired less than max_staleness
+        seconds ago. If not in cache, return default.
+        """
+        try:
+            pos, val, expires = self.data[key]
+        except KeyError:
             return default
+        if expires + max_staleness > time.time():
+            return val
+        return default
 
     def put(self, key, val, timeout=None):
         """Add key to the cache with value val
@@ -203,96 +557,301 @@ class ExpiringLRUCache(object):
         key will expire in $timeout seconds. If key is already in cache, val
         and timeout will be updated.
         """
-        # These do not change or they are just references, no need for locking.
-        maxpos = self.maxpos
-        clock_refs = self.clock_refs
-        clock_keys = self.clock_keys
-        data = self.data
-        lock = self.lock
         if timeout is None:
             timeout = self.default_timeout
 
         with self.lock:
+            clock_refs = self.clock_refs
+            clock_keys = self.clock_keys
+            data = self.data
+            max_bytes = self.max_bytes
+
+            if max_bytes is not None and self.sizeof(val) > max_bytes:
+                # Value will never fit into cache, previous value is stale.
+                entry = data.pop(key, _MARKER)
+                if entry is not _MARKER:
+                    self.total_bytes -= self.sizeof(entry[1])
+                    clock_refs[entry[0]] = False
+                return
+
             entry = data.get(key)
             if entry is not None:
                 # We already have key. Only make sure data is up to date and
                 # to remember that it was used.
                 pos = entry[0]
                 data[key] = (pos, val, time.time() + timeout)
+                if max_bytes is not None:
+                    self.total_bytes += self.sizeof(val) - self.sizeof(entry[1])
                 clock_refs[pos] = True
-                return
-            # else: key is not yet in cache. Search place to insert it.
-
-            hand = self.hand
-            count = 0
-            max_count = 107
-            while 1:
-                ref = clock_refs[hand]
-                if ref == True:
+            else:
+                # key is not yet in cache. Search place to insert it.
+                hand = self._find_victim()
+                oldkey = clock_keys[hand]
+                # Maybe oldkey was not in self.data to begin with. If it
+                # was, self.invalidate() in another thread might have
+                # already removed it. del() would raise KeyError, so pop().
+                oldentry = data.pop(oldkey, _MARKER)
+                if oldentry is not _MARKER:
+                    self.evictions += 1
+                    if max_bytes is not None:
+                        self.total_bytes -= self.sizeof(oldentry[1])
+                clock_keys[hand] = key
+                clock_refs[hand] = True
+                data[key] = (hand, val, time.time() + timeout)
+                if max_bytes is not None:
+                    self.total_bytes += self.sizeof(val)
+
+            self._shrink(key)
+
+    def _find_victim(self):
+        """Find position of entry to evict and move hand past it
+
+        Should be called with lock acquired.
+        """
+        maxpos = self.maxpos
+        clock_refs = self.clock_refs
+
+        hand = self.hand
+        count = 0
+        max_count = 107
+        while 1:
+            ref = clock_refs[hand]
+            if ref == True:
+                clock_refs[hand] = False
+                hand += 1
+                if hand > maxpos:
+                    hand = 0
+
+                count += 1
+                if count >= max_count:
+                    # We have been searching long enough. Force eviction of
+                    # next entry, no matter what its status is.
                     clock_refs[hand] = False
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-
-                    count += 1
-                    if count >= max_count:
-                        # We have been searching long enough. Force eviction of
-                        # next entry, no matter what its status is.
-                        clock_refs[hand] = False
-                else:
-                    oldkey = clock_keys[hand]
-                    # Maybe oldkey was not in self.data to begin with. If it
-                    # was, self.invalidate() in another thread might have
-                    # already removed it. del() would raise KeyError, so pop().
-                    oldentry = data.pop(oldkey, _MARKER)
-                    if oldentry is not _MARKER:
+            else:
+                victim = hand
+                hand += 1
+                if hand > maxpos:
+                    hand = 0
+                self.hand = hand
+                return victim
+
+    def _shrink(self, keep_key=_MARKER):
+        """Evict entries until values fit into max_bytes
+
+        Should be called with lock acquired.
+        """
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            return
+
+        clock_keys = self.clock_keys
+        data = self.data
+        while self.total_bytes > max_bytes and data:
+            if len(data) == 1 and keep_key in data:
+                break
+            hand = self._find_victim()
+            oldkey = clock_keys[hand]
+            if oldkey == keep_key:
+                continue
+            oldentry = data.pop(oldkey, _MARKER)
+            if oldentry is not _MARKER:
+                self.evictions += 1
+                self.total_bytes -= self.sizeof(oldentry[1])
+            clock_keys[hand] = _MARKER
+
+    def resize(self, size=None, max_bytes=_MARKER):
+        """Change number of entries and/or max_bytes keeping cached entries
+
+        When cache shrinks expired entries and then entries next to be
+        evicted by the clock are dropped first.
+        """
+        with self.lock:
+            if size is None:
+                size = self.size
+            size = int(size)
+            if size < 1:
+                raise ValueError('size must be >0')
+            if max_bytes is not _MARKER:
+                self.max_bytes = max_bytes
+
+            # Collect valid entries in order of their eviction, referenced
+            # ones last.
+            now = time.time()
+            old_size = self.size
+            unreferenced = []
+            referenced = []
+            for i in range(old_size):
+                pos = (self.hand + i) % old_size
+                key = self.clock_keys[pos]
+                entry = self.data.get(key)
+                if entry is not None and entry[0] == pos:
+                    if entry[2] <= now:
                         self.evictions += 1
-                    clock_keys[hand] = key
-                    clock_refs[hand] = True
-                    data[key] = (hand, val, time.time() + timeout)
-                    hand += 1
-                    if hand > maxpos:
-                        hand = 0
-                    self.hand = hand
-                    break
+                    elif self.clock_refs[pos]:
+                        referenced.append((key, entry[1], entry[2]))
+                    else:
+                        unreferenced.append((key, entry[1], entry[2]))
+            entries = unreferenced + referenced
+            self.evictions += max(0, len(entries) - size)
+            entries = entries[max(0, len(entries) - size):]
+
+            data = {}
+            clock_keys = [_MARKER] * size
+            clock_refs = [False] * size
+            total_bytes = 0
+            for pos, (key, val, expires) in enumerate(entries):
+                data[key] = (pos, val, expires)
+                clock_keys[pos] = key
+                clock_refs[pos] = pos >= len(entries) - len(referenced)
+                if self.max_bytes is not None:
+                    total_bytes += self.sizeof(val)
+
+            self.clock_keys = clock_keys
+            self.clock_refs = clock_refs
+            self.data = data
+            self.size = size
+            self.maxpos = size - 1
+            self.hand = len(entries) % size
+            self.total_bytes = total_bytes
+            self._shrink()
 
     def invalidate(self, key):
         """Remove key from the cache"""
+        if self.max_bytes is not None:
+            # Keep total size consistent.
+            with self.lock:
+                entry = self.data.pop(key, _MARKER)
+                if entry is not _MARKER:
+                    self.total_bytes -= self.sizeof(entry[1])
+                    self.clock_refs[entry[0]] = False
+            return
+
         # pop with default arg will not raise KeyError
         entry = self.data.pop(key, _MARKER)
         if entry is not _MARKER:
             # We have no lock, but worst thing that can happen is that we
             # set another key's entry to False.
-            self.clock_refs[entry[0]] = False
+            try:
+                self.clock_refs[entry[0]] = False
+            except IndexError:
+                # Cache was shrunk by concurrent resize().
+                pass
         # else: key was not in cache. Nothing to do.
 
 
+class _Flight(object):
+    """ Computation of cached value which concurrent callers wait for """
+    def __init__(self):
+        self.event = threading.Event()
+        self.val = None
+        self.error = None
+
+    def finish(self, val):
+        self.val = val
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.val
+
+
 class lru_cache(object):
     """ Decorator for LRU-cached function
 
     timeout parameter specifies after how many seconds a cached entry should
     be considered invalid.
+
+    policy parameter chooses cache implementation for entries without
+    timeout: "clock" for LRUCache or "slru" for scan-resistant SLRUCache.
+
+    max_bytes and sizeof parameters are passed to created cache.
+
+    If single_flight is true, concurrent calls which miss the same key wait
+    for single call of function and get its result or exception.
+
+    stale_while_revalidate parameter specifies for how many seconds after
+    expiration entry may still be returned to concurrent callers while one
+    caller computes new value. It implies single_flight and requires cache
+    with timeout.
     """
-    def __init__(self, maxsize, cache=None, timeout=None): # cache is an arg to serve tests
+    policies = {
+        "clock": LRUCache,
+        "slru": SLRUCache,
+    }
+
+    def __init__(self, maxsize, cache=None, timeout=None, policy="clock", # cache is an arg to serve tests
+                 max_bytes=None, sizeof=len, single_flight=False, stale_while_revalidate=None):
         if cache is None:
             if timeout is None:
-                cache = LRUCache(maxsize)
+                cache = self.policies[policy](maxsize, max_bytes=max_bytes, sizeof=sizeof)
             else:
-                cache = ExpiringLRUCache(maxsize, default_timeout=timeout)
+                cache = ExpiringLRUCache(maxsize, default_timeout=timeout,
+                                         max_bytes=max_bytes, sizeof=sizeof)
+        if stale_while_revalidate is not None and not hasattr(cache, "get_stale"):
+            raise ValueError('stale_while_revalidate requires cache with timeout')
         self.cache = cache
+        self.single_flight = single_flight or stale_while_revalidate is not None
+        self.stale_while_revalidate = stale_while_revalidate
 
     def __call__(self, f):
         cache = self.cache
         marker = _MARKER
-        def lru_cached(*arg):
-            val = cache.get(arg, marker)
-            if val is marker:
-                val = f(*arg)
-                cache.put(arg, val)
-            return val
+        if not self.single_flight:
+            def lru_cached(*arg):
+                val = cache.get(arg, marker)
+                if val is marker:
+                    val = f(*arg)
+                    cache.put(arg, val)
+                return val
+        else:
+            stale_while_revalidate = self.stale_while_revalidate
+            flights = {}
+            flights_lock = threading.Lock()
+            def lru_cached(*arg):
+                val = cache.get(arg, marker)
+                if val is not marker:
+                    return val
+
+                with flights_lock:
+                    flight = flights.get(arg)
+                    leader = flight is None
+                    if leader:
+                        flight = flights[arg] = _Flight()
+
+                if not leader:
+                    if stale_while_revalidate is not None:
+                        val = cache.get_stale(arg, stale_while_revalidate, marker)
+                        if val is not marker:
+                            return val
+                    return flight.wait()
+
+                try:
+                    # Previous leader could finish between lookup and
+                    # registration of the flight.
+                    val = cache.get(arg, marker)
+                    if val is marker:
+                        val = f(*arg)
+                        cache.put(arg, val)
+                except BaseException as e:
+                    # Waiting callers should not hang whatever happened.
+                    flight.fail(e)
+                    raise
+                else:
+                    flight.finish(val)
+                finally:
+                    with flights_lock:
+                        del flights[arg]
+                return val
         lru_cached.__module__ = f.__module__
         lru_cached.__name__ = f.__name__
         lru_cached.__doc__ = f.__doc__
+        lru_cached.cache = cache
         return lru_cached
 
 
@@ -332,19 +891,23 @@ class CacheMaker(object):
 
         return name, maxsize, timeout
     
-    def lrucache(self, name=None, maxsize=None):
+    def lrucache(self, name=None, maxsize=None, single_flight=False):
         """Named arguments:
         
         - name (optional) is a string, and should be unique amongst all caches
 
         - maxsize (optional) is an int, overriding any default value set by
           the constructor
+
+        - single_flight (optional) makes concurrent misses of the same key
+          wait for single call of function
         """
         name, maxsize, _ = self._resolve_setting(name, maxsize)
         cache = self._cache[name] = LRUCache(maxsize)
-        return lru_cache(maxsize, cache)
+        return lru_cache(maxsize, cache, single_flight=single_flight)
 
-    def expiring_lrucache(self, name=None, maxsize=None, timeout=None):
+    def expiring_lrucache(self, name=None, maxsize=None, timeout=None, single_flight=False,
+                          stale_while_revalidate=None):
         """Named arguments:
 
         - name (optional) is a string, and should be unique amongst all caches
@@ -354,10 +917,18 @@ class CacheMaker(object):
 
         - timeout (optional) is an int, overriding any default value set by
           the constructor or the default value (%d seconds)  
+
+        - single_flight (optional) makes concurrent misses of the same key
+          wait for single call of function
+
+        - stale_while_revalidate (optional) is number of seconds for which
+          expired entry is returned to concurrent callers while it's
+          recomputed
         """ % _DEFAULT_TIMEOUT
         name, maxsize, timeout = self._resolve_setting(name, maxsize, timeout)
         cache = self._cache[name] = ExpiringLRUCache(maxsize, timeout)
-        return lru_cache(maxsize, cache, timeout)
+        return lru_cache(maxsize, cache, timeout, single_flight=single_flight,
+                         stale_while_revalidate=stale_while_revalidate)
     
     def clear(self, *names):
         """Clear the given cache(s).
@@ -25,8 +25,6 @@
 #        - use logging
 #        - check is current way of reporting errors (by throwing exception
 #          with errno is correct)
-#        - don't read whole file on first read - implement opened streams
-#          storing and caching
 #        - create cache in /tmp by default
 #
 #  USAGE:
@@ -42,16 +40,31 @@ import pwd
 import grp
 import signal
 import datetime
+import calendar
 import binascii
+import posixpath
 import traceback
 import functools
 import stat
 import errno
 import inspect
+import time
 import shelve
+import whichdb
 import pickle
-import tempfile
+import sqlite3
+import hashlib
+import mmap
+import zlib
+import struct
 import shutil
+import Queue
+import array
+import bisect
+import ctypes
+import ctypes.util
+import fcntl
+import itertools
 
 # Import threading modules. TODO: Otherwise program prints on exit:
 # Exception KeyError: KeyError(139848519223040,) in <module 'threading' from '/usr/lib64/python2.7/threading.pyc'> ignored
@@ -59,29 +72,79 @@ import threading
 
 import fuse
 fuse.fuse_python_api = (0, 2)
-fuse.feature_assert('has_init', 'stateful_files')
+fuse.feature_assert('has_init', 'stateful_files', 'stateful_dirs')
 from fuse import Fuse
 
 import svn.repos
 import svn.fs
 import svn.core
 
-import synch
-
 # Use custom LRU cache implementation because Python's version doesn't have
 # timeout option
-from repoze_lru import lru_cache
-
+from repoze_lru import lru_cache, LRUCache, SLRUCache
 
-# TODO: Cache all immutable values, such as directory listings.
 
 # TODO: move to configuration
 check_new_revision_time = 3  # in seconds
+# Initial number of entries of attributes caches, they are resized according
+# to attr_cache_bytes when file system is initialized.
 getattr_lru_cache_size = 16384
 getattr_rev_lru_cache_size = 16384
-
-revision_dir_re = re.compile(r"^/(\d+|head)$")
-file_re = re.compile(r"^/(\d+|head)(/.*)$")
+negative_cache_size = 16384
+metadata_cache_size = 16384
+content_keys_cache_size = 16384
+# Expected memory used by entry of attributes caches, used to choose number
+# of cache entries.
+attr_cache_entry_size = 512  # in bytes
+retrieval_threads_num = 4
+# Priorities of files cache retrievals, lower are run first
+reader_retrieval_priority = 0
+background_retrieval_priority = 1
+retrieve_block_size = 4096 * 1024
+index_commit_interval = 0.5  # in seconds
+janitor_interval = 60  # in seconds
+scrub_interval = 24 * 60 * 60  # in seconds
+scrub_pause = 0.01  # in seconds, between scrubbed directories
+mmap_threshold = 1024 * 1024  # in bytes
+compressed_block_size = 64 * 1024  # in bytes
+# Files which compressed size is larger than this part of original size are
+# stored uncompressed
+compression_min_ratio = 0.9
+compressed_file_suffix = ".z"
+compressed_magic = "SVNFSZ01"
+# Magic, block size, original file size, number of blocks
+compressed_header = struct.Struct("!8sIQI")
+# Number of recently used revision roots kept opened by each thread
+revision_roots_per_thread = 16
+# Expected average size of file in contents memory cache, used to choose
+# number of cache entries.
+contents_cache_average_file_size = 4096  # in bytes
+# Expected average size of directory listing in memory cache
+dir_listings_cache_average_size = 4096  # in bytes
+# Part of maximum cache size to which cache is cleaned up
+cache_low_watermark = 0.9
+# Parts of attr_cache_bytes given to results of getattr(), revision
+# directories attributes, path lookups, nonexistent paths, node revisions
+# metadata and content keys caches
+getattr_cache_share = 0.3
+getattr_rev_cache_share = 0.05
+lookup_cache_share = 0.3
+negative_cache_share = 0.05
+metadata_cache_share = 0.15
+content_keys_cache_share = 0.15
+
+revision_dir_re = re.compile(r"^/(\d+|head|@[^/]+)$")
+file_re = re.compile(r"^/(\d+|head|@[^/]+)(/.*)$")
+# Formats of date in "/@DATE" revision directories, date is in local time or
+# in UTC if it ends with "Z".
+revision_date_formats = ["%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]
+# Revision in which node revision was created is part of FSFS node
+# revision id: "<node id>.<copy id>.r<revision>/<offset>"
+node_revision_id_rev_re = re.compile(r"\.r(\d+)/")
+node_kind_mode = {
+    svn.core.svn_node_file: stat.S_IFREG,
+    svn.core.svn_node_dir: stat.S_IFDIR,
+}
 
 
 def redirect_output(output_file):
@@ -131,6 +194,98 @@ def trace_exceptions(function):
     return wrapper
 
 
+def parse_size(size):
+    """Parse size in bytes with optional K, M or G suffix"""
+    size = size.strip().upper()
+    multiplier = 1
+    for suffix, suffix_multiplier in (("K", 1024), ("M", 1024 ** 2), ("G", 1024 ** 3)):
+        if size.endswith(suffix):
+            size = size[:-len(suffix)]
+            multiplier = suffix_multiplier
+            break
+    return int(size) * multiplier
+
+
+def parse_revision_date(date):
+    """Parse date of "/@DATE" revision directory into seconds since epoch
+
+    Returns None if date is invalid.
+    """
+    utc = date.endswith("Z")
+    if utc:
+        date = date[:-1]
+
+    for date_format in revision_date_formats:
+        try:
+            tm = time.strptime(date, date_format)
+        except ValueError:
+            continue
+
+        if utc:
+            return calendar.timegm(tm)
+        else:
+            return time.mktime(tm)
+
+    return None
+
+
+# Options which can be set in configuration file, they are reloaded on
+# SIGHUP: name -> value parser
+reloadable_options = {
+    "cache_max_bytes": parse_size,
+    "contents_cache_bytes": parse_size,
+    "contents_cache_max_file_size": parse_size,
+    "dir_listings_cache_bytes": parse_size,
+    "attr_cache_bytes": parse_size,
+    "metadata_max_entries": int,
+}
+
+
+def read_config_file(path):
+    """Read reloadable options from "name = value" lines of file
+
+    Empty lines and lines starting with "#" are ignored. Raises ValueError
+    on unknown option or invalid value.
+    """
+    options = {}
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            name, sep, value = line.partition("=")
+            name = name.strip()
+            if not sep or name not in reloadable_options:
+                raise ValueError("{0}:{1}: unknown option '{2}'".format(path, line_no, name))
+            try:
+                options[name] = reloadable_options[name](value)
+            except ValueError:
+                raise ValueError("{0}:{1}: invalid value of option '{2}'".format(path, line_no, name))
+
+    return options
+
+
+def node_ino(node_revision_id):
+    return abs(binascii.crc32(node_revision_id))
+
+
+def attr_entry_size(entry):
+    """Estimate memory used by entry of attributes caches, in bytes"""
+    return attr_cache_entry_size
+
+
+def lookup_entry_size(entry):
+    """Estimate memory used by (kind, node_revision_id) entry, in bytes"""
+    return attr_cache_entry_size + len(entry[1])
+
+
+def dir_listing_size(entries):
+    """Estimate memory used by directory listing, in bytes"""
+    # Approximate overhead of list item and tuple
+    return sum(len(name) + len(node_revision_id) + 128 for name, kind, node_revision_id in entries) + 64
+
+
 def is_write_mode(flags):
     return ((flags & os.O_WRONLY) or
             (flags & os.O_RDWR) or
@@ -168,30 +323,399 @@ def encode_node_revision_id(node_revision_id):
     return node_revision_id.encode("hex")
 
 
+def sharded_cache_file(content_key):
+    """Path of cache file relative to cache files directory
+
+    Files are distributed in two levels of directories named by first bytes
+    of contents checksum, to keep directories small.
+    """
+    digest = content_key.split("-", 1)[-1]
+    return os.path.join(digest[0:2], digest[2:4], content_key)
+
+
+def is_checksum_content_key(content_key):
+    """Check that content key is "<checksum kind>-<digest>"
+
+    Files imported from previous cache versions are keyed by their file
+    names until they are migrated.
+    """
+    return content_key.partition("-")[0] in ("sha1", "md5")
+
+
+def makedirs_if_not_exists(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class CacheIndex(object):
+    """Persistent key-value index of cache
+
+    Index is stored in SQLite database in WAL mode. All lookups are served
+    from in-memory dict mirror of database. Changes are applied to the mirror
+    immediately and written to database by writer thread in groups, one
+    transaction per group.
+
+    Mirror is loaded by load() in background, until it's loaded lookups of
+    missing keys are served from database.
+
+    If front cache (LRUCache) is specified, table isn't mirrored: only
+    recently used entries are kept in front cache and others are looked up
+    in database. Front cache is meant for indexes of immutable values, so
+    entries are put into it without synchronization with writer thread.
+    """
+
+    def __init__(self, db_path, table, version, front=None):
+        self.db_path = db_path
+        self.table = table
+        self.version = version
+        self.front = front
+
+        # Changes not written to database yet: key -> value or _deleted
+        self.pending = {}
+        # Changes being written to database
+        self.writing = {}
+        self.pending_lock = threading.Lock()
+        self.pending_event = threading.Event()
+        # Held while taken changes are being written, so flush() returns
+        # only after changes taken by writer thread are written too.
+        self.write_lock = threading.Lock()
+        self.writer_thread = None
+        # Process which started writer thread
+        self.writer_pid = None
+        self.closed = False
+        self.close_event = threading.Event()
+
+        connection = self.__connect()
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value BLOB NOT NULL)".format(
+                self.table))
+            connection.commit()
+
+            db_version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if db_version == 0:
+                self.is_new = True
+            elif db_version == self.version:
+                self.is_new = False
+            else:
+                raise RuntimeError("Cache version mismatch")
+        finally:
+            connection.close()
+
+        self.data = {}
+        self.data_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        # Keys deleted while mirror is being loaded
+        self.deleted_keys = set()
+        # Per thread connections for lookups while mirror is being loaded
+        self.local = threading.local()
+
+    _deleted = object()
+    _missing = object()
+
+    def load(self):
+        """Load all entries into mirror"""
+        if self.front is not None:
+            return
+
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            connection = self.__connect()
+            try:
+                cursor = connection.execute("SELECT key, value FROM {0}".format(self.table))
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+
+                    with self.data_lock:
+                        for key, value in rows:
+                            # Entries put or deleted after start are newer
+                            # than the stored ones.
+                            if key not in self.data and key not in self.deleted_keys:
+                                self.data[key] = pickle.loads(str(value))
+            finally:
+                connection.close()
+
+            with self.data_lock:
+                self.loaded = True
+                self.deleted_keys = set()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        connection.text_factory = str
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def __local_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.__connect()
+        return connection
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        if self.front is not None:
+            # Changes not written yet aren't counted
+            return self.__local_connection().execute("SELECT COUNT(*) FROM {0}".format(self.table)).fetchone()[0]
+
+        self.load()
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if self.front is not None:
+            return self.__get_through_front(key, default)
+
+        value = self.data.get(key, self._missing)
+        if value is not self._missing:
+            return value
+        if self.loaded:
+            return default
+
+        row = self.__local_connection().execute(
+            "SELECT value FROM {0} WHERE key = ?".format(self.table), (key,)).fetchone()
+        if row is None:
+            return default
+
+        with self.data_lock:
+            if key in self.deleted_keys:
+                return default
+            return self.data.setdefault(key, pickle.loads(str(row[0])))
+
+    def __get_through_front(self, key, default):
+        value = self.front.get(key, self._missing)
+        if value is not self._missing:
+            return value
+
+        # Entries evicted from front cache may be not written yet
+        with self.pending_lock:
+            value = self.pending.get(key, self._missing)
+            if value is self._missing:
+                value = self.writing.get(key, self._missing)
+        if value is self._deleted:
+            return default
+
+        if value is self._missing:
+            row = self.__local_connection().execute(
+                "SELECT value FROM {0} WHERE key = ?".format(self.table), (key,)).fetchone()
+            if row is None:
+                return default
+            value = pickle.loads(str(row[0]))
+
+        self.front.put(key, value)
+        return value
+
+    def iteritems(self):
+        if self.front is not None:
+            return self.__iter_database()
+
+        self.load()
+        return self.data.items()
+
+    def __iter_database(self):
+        connection = self.__connect()
+        try:
+            cursor = connection.execute("SELECT key, value FROM {0}".format(self.table))
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+
+                for key, value in rows:
+                    yield key, pickle.loads(str(value))
+        finally:
+            connection.close()
+
+    def put(self, key, value):
+        if self.front is not None:
+            self.front.put(key, value)
+        else:
+            with self.data_lock:
+                self.data[key] = value
+                self.deleted_keys.discard(key)
+        self.__add_pending(key, value)
+
+    def delete(self, key):
+        if self.front is not None:
+            self.front.invalidate(key)
+        else:
+            with self.data_lock:
+                self.data.pop(key, None)
+                if not self.loaded:
+                    self.deleted_keys.add(key)
+        self.__add_pending(key, self._deleted)
+
+    def prune(self, max_entries):
+        """Delete oldest written entries until at most max_entries are left
+
+        Entries are ordered by time they were written to database, front
+        cache isn't changed. Returns number of deleted entries.
+        """
+        connection = self.__connect()
+        try:
+            with connection:
+                count = connection.execute("SELECT COUNT(*) FROM {0}".format(self.table)).fetchone()[0]
+                if count <= max_entries:
+                    return 0
+
+                # Replaced rows get new rowid, so rowid follows write order.
+                connection.execute(
+                    "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} ORDER BY rowid LIMIT ?)".format(
+                        self.table), (count - max_entries,))
+                return count - max_entries
+        finally:
+            connection.close()
+
+    def __add_pending(self, key, value):
+        with self.pending_lock:
+            self.pending[key] = value
+
+            if (self.writer_thread is None or self.writer_pid != os.getpid()) and not self.closed:
+                # Thread is started on demand, because FUSE forks process
+                # after cache creation. Thread isn't inherited by forked
+                # process, so it's started again there.
+                self.writer_thread = threading.Thread(target=self.__writer_thread)
+                self.writer_thread.daemon = True
+                self.writer_thread.start()
+                self.writer_pid = os.getpid()
+
+        self.pending_event.set()
+
+    def import_items(self, items):
+        """Put entries of dict, writing them to database immediately
+
+        Used to import indexes of previous cache versions, which is done
+        before FUSE forks process, so writer thread isn't started.
+        """
+        connection = self.__connect()
+        try:
+            with self.write_lock:
+                self.__write(connection, items)
+        finally:
+            connection.close()
+
+        for key, value in items.iteritems():
+            if self.front is not None:
+                self.front.put(key, value)
+            else:
+                with self.data_lock:
+                    self.data[key] = value
+                    self.deleted_keys.discard(key)
+
+    def close(self):
+        """Stop writer thread and write all pending changes to database"""
+        with self.pending_lock:
+            self.closed = True
+            writer_thread = self.writer_thread
+        if writer_thread is not None and self.writer_pid == os.getpid():
+            self.pending_event.set()
+            self.close_event.set()
+            writer_thread.join()
+        self.flush()
+
+    def flush(self):
+        """Write all pending changes to database"""
+        with self.write_lock:
+            pending = self.__take_pending()
+
+            connection = self.__connect()
+            try:
+                self.__write(connection, pending)
+            finally:
+                connection.close()
+                self.__written()
+
+    def __take_pending(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            self.writing = pending
+            if not self.closed:
+                # Event is kept set, so writer thread notices closing.
+                self.pending_event.clear()
+        return pending
+
+    def __written(self):
+        with self.pending_lock:
+            self.writing = {}
+
+    def __write(self, connection, pending):
+        with connection:
+            if self.is_new:
+                connection.execute("PRAGMA user_version={0:d}".format(self.version))
+                self.is_new = False
+
+            connection.executemany("INSERT OR REPLACE INTO {0} (key, value) VALUES (?, ?)".format(self.table),
+                [(key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                 for key, value in pending.iteritems() if value is not self._deleted])
+            connection.executemany("DELETE FROM {0} WHERE key = ?".format(self.table),
+                [(key,) for key, value in pending.iteritems() if value is self._deleted])
+
+    def __writer_thread(self):
+        connection = self.__connect()
+        while True:
+            self.pending_event.wait()
+            if self.closed:
+                # Pending changes are written by close()
+                break
+            # Let more changes to be grouped into one transaction.
+            self.close_event.wait(index_commit_interval)
+
+            with self.write_lock:
+                pending = self.__take_pending()
+                if not pending:
+                    # Already written by flush()
+                    continue
+
+                try:
+                    self.__write(connection, pending)
+                except Exception:
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                finally:
+                    self.__written()
+
+        connection.close()
+
+
 class FilesCache(object):
-    # TODO: store files not in plain directory, but in equally distributed
-    # tree.
-    # TODO: touch opened files, to allow implementing external cache
-    # cleaning.
+    """Cache of files contents
+
+    Contents are stored once for all node revisions with the same contents,
+    cache files are named by contents checksum (content key). Index maps node
+    revisions to content keys.
+    """
+
+    cache_version = 3
 
-    cache_version = 1
+    eviction_policies = {
+        # Least recently used files are evicted first
+        "lru": lambda entry: entry["last_access"],
+        # Least frequently used files are evicted first
+        "lfu": lambda entry: (entry["accesses"], entry["last_access"]),
+    }
 
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, max_bytes=None, eviction_policy="lru", compression=False,
+                 resolve_content_key=None, metadata_max_entries=None):
         self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.metadata_max_entries = metadata_max_entries
+        self.compression = compression
+        # Returns content key of node revision, or None if it's not found,
+        # used to migrate files of previous cache versions.
+        self.resolve_content_key = resolve_content_key
+        self.eviction_key = self.eviction_policies[eviction_policy]
 
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-        self.cache_db = shelve.open(os.path.join(self.cache_dir, "db"), protocol=pickle.HIGHEST_PROTOCOL)
-        if "version" not in self.cache_db:
-            self.cache_db["version"] = self.cache_version
-        elif self.cache_db["version"] != self.cache_version:
-            raise RuntimeError("Cache version mismatch")
-
-        self.cache_db.sync()
-
-        self.cache_db_lock = synch.RWLock()
-
         self.cache_files_dir = os.path.join(self.cache_dir, "cache")
         self.cache_temp_dir = os.path.join(self.cache_dir, "tmp")
 
@@ -200,47 +724,571 @@ class FilesCache(object):
         if not os.path.isdir(self.cache_temp_dir):
             os.mkdir(self.cache_temp_dir)
 
-        assert self.check_integrity()
+        db_path = os.path.join(self.cache_dir, "cache_index.sqlite")
+        # content_key -> cache file entry
+        self.cache_db = CacheIndex(db_path, "contents", self.cache_version)
+        # node_revision_id -> content_key and node_revision_id -> node
+        # metadata, there may be entries for every node revision of
+        # repository, so only recently used are kept in memory.
+        self.content_keys_cache = LRUCache(content_keys_cache_size,
+                                           max_bytes=content_keys_cache_size * attr_cache_entry_size,
+                                           sizeof=attr_entry_size)
+        self.nodes_db = CacheIndex(db_path, "nodes", self.cache_version, front=self.content_keys_cache)
+        self.metadata_cache = LRUCache(metadata_cache_size, max_bytes=metadata_cache_size * attr_cache_entry_size,
+                                       sizeof=attr_entry_size)
+        self.metadata_db = CacheIndex(db_path, "metadata", self.cache_version, front=self.metadata_cache)
+
+        self.cache_db_lock = threading.Lock()
+
+        # Contents which are being retrieved right now:
+        # content_key -> FileRetrieval.
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.duplicate_fetches_avoided = 0
+
+        # (priority, sequence number, FileRetrieval), retrievals requested by
+        # readers are run before background ones.
+        self.retrieval_queue = Queue.PriorityQueue()
+        self.retrieval_sequence = itertools.count()
+        self.retrieval_threads = []
+
+        # Contents opened for reading: content_key -> number of opened
+        # handles. Pinned files are never evicted.
+        self.pins = {}
+        self.pins_lock = threading.Lock()
+
+        # Contents which access statistics are not written to index.
+        self.touched = set()
+        self.total_size = 0
+        self.evictions = 0
+        self.pruned_metadata = 0
+        self.janitor_event = threading.Event()
+        self.janitor_thread = None
+        self.started = False
+        self.migrated_files = 0
+        self.repaired_entries = 0
+
+        shelve_db_path = os.path.join(self.cache_dir, "db")
+        if whichdb.whichdb(shelve_db_path) is not None:
+            self.__migrate_shelve_db(shelve_db_path)
+
+        index_v2_path = os.path.join(self.cache_dir, "index.sqlite")
+        if os.path.exists(index_v2_path):
+            self.__migrate_index_v2(index_v2_path)
+
+    def start(self):
+        """Start cache maintenance, should be called after FUSE daemonized
+
+        Index loading, cache size calculation and integrity checking are
+        performed in background, cache is usable meanwhile.
+        """
+        maintenance_thread = threading.Thread(target=self.__maintenance_thread)
+        maintenance_thread.daemon = True
+        maintenance_thread.start()
+
+        self.started = True
+        if self.max_bytes is not None or self.metadata_max_entries is not None:
+            self.__start_janitor()
+
+    def __start_janitor(self):
+        if self.janitor_thread is None:
+            self.janitor_thread = threading.Thread(target=self.__janitor_thread)
+            self.janitor_thread.daemon = True
+            self.janitor_thread.start()
+
+    def resize(self, max_bytes, metadata_max_entries=None):
+        """Change maximum size of cache and number of stored node revisions
+        metadata, None means unlimited
+
+        Excess files and metadata are evicted in background.
+        """
+        self.max_bytes = max_bytes
+        self.metadata_max_entries = metadata_max_entries
+        if (max_bytes is not None or metadata_max_entries is not None) and self.started:
+            self.__start_janitor()
+            self.janitor_event.set()
+
+    def __maintenance_thread(self):
+        while True:
+            try:
+                self.cache_db.load()
+
+                with self.cache_db_lock:
+                    self.total_size = sum(entry["size"] for _, entry in self.cache_db.iteritems())
+
+                if not all(is_checksum_content_key(key) for key, _ in self.cache_db.iteritems()):
+                    sys.stdout.write("Migrating files of previous cache version\n")
+                    sys.stdout.flush()
+                    self.migrate_legacy_files()
+                    sys.stdout.write("Files cache migration finished, {0} files migrated\n".format(
+                        self.migrated_files))
+                    sys.stdout.flush()
+
+                if any(os.sep not in entry["cache_file"] for _, entry in self.cache_db.iteritems()):
+                    sys.stdout.write("Migrating files cache to sharded layout\n")
+                    sys.stdout.flush()
+                    self.migrate_layout()
+                    sys.stdout.write("Files cache migration finished, {0} files moved\n".format(
+                        self.migrated_files))
+                    sys.stdout.flush()
+
+                self.fix_integrity()
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+            time.sleep(scrub_interval)
+
+    def migrate_layout(self):
+        """Move files from flat cache directory into sharded layout
+
+        Cache is usable during migration: readers which lookup file just
+        before it's moved fail to open it and look it up again.
+        """
+        for content_key, entry in self.cache_db.iteritems():
+            if os.sep in entry["cache_file"]:
+                continue
+
+            with self.cache_db_lock:
+                entry = self.cache_db.get(content_key)
+                if entry is None:
+                    # Evicted
+                    continue
+
+                cache_file = sharded_cache_file(content_key)
+                if entry["cache_file"].endswith(compressed_file_suffix):
+                    cache_file += compressed_file_suffix
+                full_path = os.path.join(self.cache_files_dir, cache_file)
+                makedirs_if_not_exists(os.path.dirname(full_path))
+                os.rename(os.path.join(self.cache_files_dir, entry["cache_file"]), full_path)
+
+                self.cache_db.put(content_key, dict(entry, cache_file=cache_file))
+                self.migrated_files += 1
+
+    def __migrate_shelve_db(self, shelve_db_path):
+        """Import index from version 1 cache, stored in shelve database"""
+        shelve_db = shelve.open(shelve_db_path, flag="r", protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            if shelve_db.get("version") != 1:
+                raise RuntimeError("Cache version mismatch")
+
+            self.__import_node_files((key, value["cache_file"]) for key, value in shelve_db.iteritems()
+                                     if key != "version")
+        finally:
+            shelve_db.close()
+
+        for file_name in os.listdir(self.cache_dir):
+            if file_name == "db" or file_name.startswith("db."):
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+    def __migrate_index_v2(self, index_v2_path):
+        """Import index from version 2 cache, stored by node revision"""
+        connection = sqlite3.connect(index_v2_path, timeout=60)
+        connection.text_factory = str
+        try:
+            if connection.execute("PRAGMA user_version").fetchone()[0] != 2:
+                raise RuntimeError("Cache version mismatch")
+
+            self.__import_node_files((key, pickle.loads(str(value))["cache_file"])
+                                     for key, value in connection.execute("SELECT key, value FROM entries"))
+        finally:
+            connection.close()
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(index_v2_path + suffix):
+                os.remove(index_v2_path + suffix)
+
+    def __import_node_files(self, node_files):
+        """Import files cached by node revision id by previous cache versions
+
+        node_files are (node_revision_id, cache_file) pairs. Files are served
+        by their file names as content keys until they are migrated by
+        migrate_legacy_files() in background, so mount isn't delayed by
+        reading all cached files.
+        """
+        cache_entries = {}
+        node_entries = {}
+        for node_revision_id, cache_file in node_files:
+            full_path = os.path.join(self.cache_files_dir, cache_file)
+            if not os.path.exists(full_path):
+                continue
+
+            cache_entries[cache_file] = dict(cache_file=cache_file,
+                                             size=os.path.getsize(full_path),
+                                             last_access=time.time(),
+                                             accesses=0)
+            node_entries[node_revision_id] = cache_file
+
+        self.cache_db.import_items(cache_entries)
+        self.nodes_db.import_items(node_entries)
+
+    def __legacy_file_content_key(self, node_revision_id, full_path):
+        if self.resolve_content_key is not None:
+            return self.resolve_content_key(node_revision_id)
+
+        sha1 = hashlib.sha1()
+        with open(full_path, "rb") as f:
+            while True:
+                block = f.read(retrieve_block_size)
+                if len(block) == 0:
+                    break
+                sha1.update(block)
+        return "sha1-" + sha1.hexdigest()
+
+    def migrate_legacy_files(self):
+        """Move files imported from previous cache versions to content keys
+
+        Content key is found by resolve_content_key(), so it's the same as
+        for newly retrieved contents, or calculated as SHA-1 of contents if
+        resolver isn't specified. Files which node revisions aren't found and
+        duplicates of cached contents are removed.
+        """
+        for node_revision_id, legacy_key in self.nodes_db.iteritems():
+            if is_checksum_content_key(legacy_key):
+                continue
+
+            entry = self.cache_db.get(legacy_key)
+            content_key = None
+            if entry is not None:
+                try:
+                    content_key = self.__legacy_file_content_key(
+                        node_revision_id, os.path.join(self.cache_files_dir, entry["cache_file"]))
+                except Exception:
+                    traceback.print_exc()
+                    sys.stderr.flush()
+
+            with self.cache_db_lock:
+                entry = self.cache_db.get(legacy_key)
+                if entry is not None:
+                    self.cache_db.delete(legacy_key)
+                    self.total_size -= entry["size"]
+                    full_path = os.path.join(self.cache_files_dir, entry["cache_file"])
+
+                    if content_key is not None and content_key not in self.cache_db:
+                        new_cache_file = sharded_cache_file(content_key)
+                        new_full_path = os.path.join(self.cache_files_dir, new_cache_file)
+                        makedirs_if_not_exists(os.path.dirname(new_full_path))
+                        os.rename(full_path, new_full_path)
+
+                        self.cache_db.put(content_key, dict(entry, cache_file=new_cache_file))
+                        self.total_size += entry["size"]
+                        self.migrated_files += 1
+                    else:
+                        os.remove(full_path)
+
+                if content_key is not None:
+                    self.nodes_db.put(node_revision_id, content_key)
+                else:
+                    self.nodes_db.delete(node_revision_id)
+
+            # Let cache users work with disk
+            time.sleep(scrub_pause)
 
     def check_integrity(self):
-        with self.cache_db_lock.read_lock():
-            dir_cache_files = os.listdir(self.cache_files_dir)
-            db_cache_files = []
-            for key, value in self.cache_db.iteritems():
-                if key != "version":
-                    db_cache_files.append(value["cache_file"])
+        dir_cache_files = []
+        for dir_path, _, file_names in os.walk(self.cache_files_dir):
+            relative_dir_path = os.path.relpath(dir_path, self.cache_files_dir)
+            for file_name in file_names:
+                dir_cache_files.append(os.path.normpath(os.path.join(relative_dir_path, file_name)))
 
-            return set(dir_cache_files) == set(db_cache_files)
+        db_cache_files = []
+        for key, value in self.cache_db.iteritems():
+            db_cache_files.append(value["cache_file"])
+
+        return set(dir_cache_files) == set(db_cache_files)
 
     def fix_integrity(self):
-        """Check non-existing or not-registered items and removes them"""
-        # TODO
-        pass
+        """Check non-existing or not-registered items and removes them
+
+        Index entries without cache files are removed, not registered cache
+        files are registered by build_db_from_cache(). Cache is locked only
+        while single item is repaired.
+        """
+        for content_key, entry in self.cache_db.iteritems():
+            if os.path.exists(os.path.join(self.cache_files_dir, entry["cache_file"])):
+                continue
+
+            with self.cache_db_lock:
+                # Check again: file could be moved during layout migration.
+                entry = self.cache_db.get(content_key)
+                if entry is None or os.path.exists(os.path.join(self.cache_files_dir, entry["cache_file"])):
+                    continue
+
+                self.cache_db.delete(content_key)
+                self.total_size -= entry["size"]
+                self.repaired_entries += 1
+
+        self.build_db_from_cache()
+
+        # Partial files of already cached contents are left if program
+        # terminated just after retrieval.
+        for file_name in os.listdir(self.cache_temp_dir):
+            content_key, ext = os.path.splitext(file_name)
+            if ext == ".partial" and content_key not in self.in_flight and content_key in self.cache_db:
+                try:
+                    os.remove(os.path.join(self.cache_temp_dir, file_name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
 
     def build_db_from_cache(self):
-        """Built cache database from existing files cache"""
-        # TODO
-        pass
+        """Built cache database from existing files cache
+
+        Registers cache files which are missing in index, e.g. because
+        program terminated before index changes were written. Files which
+        contents don't match their names are removed.
+        """
+        for dir_path, _, file_names in os.walk(self.cache_files_dir):
+            for file_name in file_names:
+                full_path = os.path.join(dir_path, file_name)
+                cache_file = os.path.relpath(full_path, self.cache_files_dir)
+                content_key = file_name
+                if content_key.endswith(compressed_file_suffix):
+                    content_key = content_key[:-len(compressed_file_suffix)]
+
+                entry = self.cache_db.get(content_key)
+                if entry is not None and entry["cache_file"] == cache_file:
+                    continue
+
+                is_valid = self.__verify_cache_file(content_key, full_path)
+
+                with self.cache_db_lock:
+                    entry = self.cache_db.get(content_key)
+                    if entry is not None and entry["cache_file"] == cache_file:
+                        # Registered meanwhile
+                        continue
+                    if not os.path.exists(full_path):
+                        continue
+
+                    self.repaired_entries += 1
+
+                    if not is_valid or entry is not None:
+                        os.remove(full_path)
+                        continue
+
+                    self.cache_db.put(content_key, dict(cache_file=cache_file,
+                                                        size=os.path.getsize(full_path),
+                                                        last_access=time.time(),
+                                                        accesses=0))
+                    self.total_size += os.path.getsize(full_path)
+
+            # Let cache users work with disk
+            time.sleep(scrub_pause)
+
+    def __verify_cache_file(self, content_key, full_path):
+        """Check that cache file contents match their content key"""
+        if not is_checksum_content_key(content_key):
+            return False
+        kind, _, digest = content_key.partition("-")
+
+        checksum = hashlib.new(kind)
+        try:
+            reader = open_cache_file(full_path)
+        except IOError as e:
+            if e.errno == errno.EIO:
+                # Broken compressed file
+                return False
+            raise
+        try:
+            offset = 0
+            while True:
+                try:
+                    block = reader.read(retrieve_block_size, offset)
+                except zlib.error:
+                    # Broken compressed file
+                    return False
+                if len(block) == 0:
+                    break
+                checksum.update(block)
+                offset += len(block)
+        finally:
+            reader.close()
+
+        return checksum.hexdigest() == digest
 
-    def get_file_path(self, node_revision_id):
-        with self.cache_db_lock.read_lock():
-            if node_revision_id in self.cache_db:
-                cache_file = self.cache_db[node_revision_id]["cache_file"]
-                return os.path.join(self.cache_files_dir, cache_file)
+    def flush(self):
+        self.__write_access_statistics()
+        self.cache_db.flush()
+        self.nodes_db.flush()
+        self.metadata_db.flush()
+
+    def close(self):
+        """Write all index changes and stop index writer threads"""
+        self.__write_access_statistics()
+        self.cache_db.close()
+        self.nodes_db.close()
+        self.metadata_db.close()
+
+    def get_content_key(self, node_revision_id):
+        return self.nodes_db.get(node_revision_id)
+
+    def put_content_key(self, node_revision_id, content_key):
+        self.nodes_db.put(node_revision_id, content_key)
+
+    def get_metadata(self, node_revision_id):
+        return self.metadata_db.get(node_revision_id)
+
+    def put_metadata(self, node_revision_id, metadata):
+        self.metadata_db.put(node_revision_id, metadata)
+
+    def pin(self, content_key):
+        with self.pins_lock:
+            self.pins[content_key] = self.pins.get(content_key, 0) + 1
+
+    def unpin(self, content_key):
+        with self.pins_lock:
+            count = self.pins[content_key] - 1
+            if count > 0:
+                self.pins[content_key] = count
             else:
+                del self.pins[content_key]
+
+    def open_file(self, content_key):
+        """Open cached file for reading
+
+        Returns CacheFileReader (or CompressedCacheFileReader) or None if
+        file is not cached yet. Caller
+        should pin file while it's opened.
+        """
+        while True:
+            cache_file = self.get_file_path(content_key)
+            if cache_file is None:
                 return None
 
-    def put_file(self, node_revision_id, temp_file_path):
-        with self.cache_db_lock.write_lock():
-            if node_revision_id not in self.cache_db:
+            try:
+                reader = open_cache_file(cache_file)
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    # File was moved between lookup and opening.
+                    continue
+                raise
+
+            self.touch(content_key)
+            return reader
+
+    def touch(self, content_key, access=True):
+        """Update access statistics of cached file
+
+        Every opening counts as an access, reads of opened file only mark it
+        as recently used (access=False).
+        """
+        with self.cache_db_lock:
+            entry = self.cache_db.get(content_key)
+            if entry is not None:
+                # Statistics are updated in the index mirror only and written
+                # to database by janitor.
+                entry["last_access"] = time.time()
+                if access:
+                    entry["accesses"] += 1
+                self.touched.add(content_key)
+
+    def __write_access_statistics(self):
+        # Lock keeps touches from being lost between swap and writing, and
+        # evicted entries from being written back.
+        with self.cache_db_lock:
+            touched, self.touched = self.touched, set()
+            for content_key in touched:
+                entry = self.cache_db.get(content_key)
+                if entry is not None:
+                    self.cache_db.put(content_key, entry)
+
+    def __janitor_thread(self):
+        while True:
+            self.janitor_event.wait(janitor_interval)
+            self.janitor_event.clear()
+
+            try:
+                self.clean_up()
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+    def clean_up(self):
+        """Write access statistics and evict files and metadata over limits
+
+        Files are evicted to low watermark of maximum cache size.
+        """
+        self.__write_access_statistics()
+        max_bytes = self.max_bytes
+        if max_bytes is not None and self.total_size > max_bytes:
+            self.evict(int(max_bytes * cache_low_watermark))
+        self.prune_metadata()
+
+    def evict(self, target_size):
+        """Evict files from cache until its size is not more than target_size"""
+        candidates = sorted(self.cache_db.iteritems(), key=lambda item: self.eviction_key(item[1]))
+
+        for content_key, entry in candidates:
+            if self.total_size <= target_size:
+                break
+
+            with self.cache_db_lock:
+                # Files which are opened or being retrieved are not evicted.
+                with self.pins_lock:
+                    if content_key in self.pins:
+                        continue
+                if content_key in self.in_flight:
+                    continue
+
+                entry = self.cache_db.get(content_key)
+                if entry is None:
+                    continue
+
+                self.cache_db.delete(content_key)
+                self.total_size -= entry["size"]
+                self.evictions += 1
+
+                try:
+                    os.remove(os.path.join(self.cache_files_dir, entry["cache_file"]))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def prune_metadata(self):
+        """Delete oldest node revisions metadata and content keys if there are
+        more entries than metadata_max_entries
+
+        Entries are pruned to low watermark, pruned entries are calculated
+        again when needed. Content keys of evicted contents are kept until
+        they are pruned, they spare checksum lookup when file is read again.
+        """
+        max_entries = self.metadata_max_entries
+        if max_entries is None:
+            return
+
+        for index in (self.metadata_db, self.nodes_db):
+            if len(index) > max_entries:
+                self.pruned_metadata += index.prune(int(max_entries * cache_low_watermark))
+
+    def get_file_path(self, content_key):
+        entry = self.cache_db.get(content_key)
+        if entry is not None:
+            return os.path.join(self.cache_files_dir, entry["cache_file"])
+        else:
+            return None
+
+    def put_file(self, content_key, temp_file_path, compressed=False):
+        with self.cache_db_lock:
+            entry = self.cache_db.get(content_key)
+            if entry is None:
                 # File still not cached
-                cache_file = encode_node_revision_id(node_revision_id)
+                cache_file = sharded_cache_file(content_key)
+                if compressed:
+                    cache_file += compressed_file_suffix
                 full_path = os.path.join(self.cache_files_dir, cache_file)
+                makedirs_if_not_exists(os.path.dirname(full_path))
 
                 shutil.move(temp_file_path, full_path)
 
-                self.cache_db[node_revision_id] = dict(cache_file=cache_file)
-                self.cache_db.sync()
+                size = os.path.getsize(full_path)
+                self.cache_db.put(content_key, dict(cache_file=cache_file,
+                                                         size=size,
+                                                         last_access=time.time(),
+                                                         accesses=1))
+                self.total_size += size
+                max_bytes = self.max_bytes
+                if max_bytes is not None and self.total_size > max_bytes:
+                    self.janitor_event.set()
 
                 return full_path
             else:
@@ -248,8 +1296,790 @@ class FilesCache(object):
 
                 os.remove(temp_file_path)
 
-                cache_file = self.cache_db[node_revision_id]["cache_file"]
-                return os.path.join(self.cache_files_dir, cache_file)
+                return os.path.join(self.cache_files_dir, entry["cache_file"])
+
+    def read_file(self, content_key, size, retrieve, length, offset, requester=None, background=False):
+        """Read range of file contents, retrieving file into cache if needed
+
+        Not cached file is retrieved in background by one of cache retrieval
+        threads, reader waits only until requested range is retrieved.
+        retrieve(offset) should return iterator over file contents blocks
+        starting from offset.
+
+        When several requesters read same not cached file simultaneously only
+        one retrieval is performed.
+
+        Background retrievals, e.g. warm ups, are started only when no
+        retrievals requested by readers are queued.
+        """
+        while True:
+            reader = self.open_file(content_key)
+            if reader is not None:
+                try:
+                    return reader.read(length, offset)
+                finally:
+                    reader.close()
+
+            retrieval = self.__get_retrieval(content_key, size, retrieve, requester, background)
+            if retrieval is None:
+                # File was cached between lookups
+                continue
+
+            data = retrieval.read(length, offset)
+            if data is not None:
+                return data
+            # else: retrieval finished and file is in cache now.
+
+    def __queue_retrieval(self, retrieval, priority):
+        self.retrieval_queue.put((priority, next(self.retrieval_sequence), retrieval))
+
+    def __get_retrieval(self, content_key, size, retrieve, requester, background=False):
+        with self.in_flight_lock:
+            retrieval = self.in_flight.get(content_key)
+            if retrieval is not None:
+                if retrieval.add_requester(requester):
+                    self.duplicate_fetches_avoided += 1
+                if retrieval.background and not background and not retrieval.started:
+                    # Reader waits for queued background retrieval, queue it
+                    # again with reader priority, it's run only once.
+                    retrieval.background = False
+                    self.__queue_retrieval(retrieval, reader_retrieval_priority)
+                return retrieval
+
+            if self.get_file_path(content_key):
+                return None
+
+            if not self.retrieval_threads:
+                # Threads are started on demand, because FUSE forks process
+                # after cache creation.
+                for _ in xrange(retrieval_threads_num):
+                    thread = threading.Thread(target=self.__retrieval_thread)
+                    thread.daemon = True
+                    thread.start()
+                    self.retrieval_threads.append(thread)
+
+            partial_file_path = os.path.join(self.cache_temp_dir, content_key + ".partial")
+            retrieval = FileRetrieval(content_key, size, partial_file_path, retrieve)
+            retrieval.background = background
+            retrieval.add_requester(requester)
+            self.in_flight[content_key] = retrieval
+            self.__queue_retrieval(retrieval, background_retrieval_priority if background
+                                   else reader_retrieval_priority)
+
+            return retrieval
+
+    def __retrieval_thread(self):
+        while True:
+            priority, sequence, retrieval = self.retrieval_queue.get()
+
+            with self.in_flight_lock:
+                if retrieval.started:
+                    # Promoted retrieval was queued twice
+                    continue
+                retrieval.started = True
+
+            try:
+                retrieval.run()
+
+                compressed_file_path = None
+                if self.compression:
+                    # Readers are served from partial file meanwhile.
+                    compressed_file_path = os.path.join(self.cache_temp_dir,
+                                                        retrieval.content_key + compressed_file_suffix)
+                    if not compress_cache_file(retrieval.partial_file_path, compressed_file_path):
+                        # Not compressible enough, store as is.
+                        os.remove(compressed_file_path)
+                        compressed_file_path = None
+
+                with retrieval.condition:
+                    if compressed_file_path is not None:
+                        cache_file = self.put_file(retrieval.content_key, compressed_file_path,
+                                                   compressed=True)
+                        os.remove(retrieval.partial_file_path)
+                    else:
+                        cache_file = self.put_file(retrieval.content_key,
+                                                   retrieval.partial_file_path)
+                    retrieval.finish(cache_file)
+            except Exception as e:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+                with self.in_flight_lock:
+                    del self.in_flight[retrieval.content_key]
+                retrieval.fail(e)
+            else:
+                with self.in_flight_lock:
+                    del self.in_flight[retrieval.content_key]
+
+
+def compress_cache_file(src_path, dest_path):
+    """Write compressed copy of file
+
+    Compressed file consists of header, table of blocks offsets and
+    independently compressed with zlib blocks of compressed_block_size bytes
+    of original file, so any range can be read without decompressing whole
+    file.
+
+    Returns False if file is not compressible enough to be stored compressed.
+    """
+    size = os.path.getsize(src_path)
+    blocks_num = (size + compressed_block_size - 1) // compressed_block_size
+    offsets_format = "!{0:d}Q".format(blocks_num + 1)
+    data_offset = compressed_header.size + struct.calcsize(offsets_format)
+
+    offsets = [data_offset]
+    with open(src_path, "rb") as src:
+        with open(dest_path, "wb") as dest:
+            dest.seek(data_offset)
+            while True:
+                block = src.read(compressed_block_size)
+                if len(block) == 0:
+                    break
+                compressed_block = zlib.compress(block)
+                dest.write(compressed_block)
+                offsets.append(offsets[-1] + len(compressed_block))
+
+            dest.seek(0)
+            dest.write(compressed_header.pack(compressed_magic, compressed_block_size, size, blocks_num))
+            dest.write(struct.pack(offsets_format, *offsets))
+
+    return offsets[-1] <= size * compression_min_ratio
+
+
+def open_cache_file(path):
+    if path.endswith(compressed_file_suffix):
+        return CompressedCacheFileReader(path)
+    else:
+        return CacheFileReader(path)
+
+
+class CacheFileReader(object):
+    """Opened cache file
+
+    Files not smaller than mmap_threshold are memory mapped, reads from
+    them are served by slicing the mapping.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+
+        self.mmap = None
+        if os.fstat(self.file.fileno()).st_size >= mmap_threshold:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, length, offset):
+        if self.mmap is not None:
+            return self.mmap[offset:offset + length]
+
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+
+class CompressedCacheFileReader(object):
+    """Opened compressed cache file
+
+    Only blocks containing requested range are decompressed, last
+    decompressed block is kept for sequential reads.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+
+        try:
+            magic, self.block_size, self.size, blocks_num = compressed_header.unpack(
+                self.file.read(compressed_header.size))
+            if magic != compressed_magic:
+                raise struct.error("invalid magic")
+
+            offsets_format = "!{0:d}Q".format(blocks_num + 1)
+            self.offsets = struct.unpack(offsets_format, self.file.read(struct.calcsize(offsets_format)))
+        except struct.error:
+            self.file.close()
+            raise IOError(errno.EIO, "Broken compressed cache file: {0}".format(path))
+
+        self.last_block = (None, None)
+
+    def __get_block(self, index):
+        last_index, last_block = self.last_block
+        if last_index == index:
+            return last_block
+
+        with self.lock:
+            self.file.seek(self.offsets[index])
+            compressed_block = self.file.read(self.offsets[index + 1] - self.offsets[index])
+
+        block = zlib.decompress(compressed_block)
+        self.last_block = (index, block)
+        return block
+
+    def read(self, length, offset):
+        end = min(offset + length, self.size)
+
+        chunks = []
+        while offset < end:
+            index = offset // self.block_size
+            block_offset = offset - index * self.block_size
+            chunk = self.__get_block(index)[block_offset:block_offset + end - offset]
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        return "".join(chunks)
+
+    def close(self):
+        self.file.close()
+
+
+class FileRetrieval(object):
+    """File contents being retrieved into files cache
+
+    Contents are written sequentially into partial file in cache temporary
+    directory, ready_size is the number of bytes already written and
+    available for reading. Partial file is left on retrieval failure or
+    program termination and retrieval is resumed from it next time.
+    """
+
+    def __init__(self, content_key, size, partial_file_path, retrieve):
+        self.content_key = content_key
+        self.size = size
+        self.partial_file_path = partial_file_path
+        self.retrieve = retrieve
+
+        self.condition = threading.Condition()
+        self.ready_size = 0
+        self.cache_file = None
+        self.error = None
+        self.requesters = set()
+        # Retrieval is not requested by readers
+        self.background = False
+        # Retrieval is taken by retrieval thread
+        self.started = False
+
+        if os.path.exists(self.partial_file_path):
+            # Last block could be written partially, retrieve it again.
+            partial_size = os.path.getsize(self.partial_file_path)
+            self.ready_size = min(partial_size - partial_size % retrieve_block_size, self.size)
+
+    def add_requester(self, requester):
+        """Register reader of file, returns True if it's not the first one"""
+        key = id(requester) if requester is not None else object()
+        is_new = key not in self.requesters
+        self.requesters.add(key)
+        return is_new and len(self.requesters) > 1
+
+    def run(self):
+        with open(self.partial_file_path, "ab") as f:
+            f.truncate(self.ready_size)
+
+            for block in self.retrieve(self.ready_size):
+                f.write(block)
+                f.flush()
+
+                with self.condition:
+                    self.ready_size += len(block)
+                    self.condition.notify_all()
+
+        if self.ready_size != self.size:
+            raise IOError(errno.EIO, "Retrieved {0} bytes of {1} for {2}".format(
+                self.ready_size, self.size, self.content_key))
+
+    def finish(self, cache_file):
+        with self.condition:
+            self.cache_file = cache_file
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def read(self, length, offset):
+        """Read contents range, waiting until it is retrieved
+
+        Returns None if retrieval is finished and contents should be read
+        from the files cache.
+        """
+        end = max(min(offset + length, self.size), offset)
+        if end == offset:
+            # Nothing to read, partial file may be not created yet.
+            return ""
+
+        with self.condition:
+            while self.ready_size < end and self.cache_file is None and self.error is None:
+                self.condition.wait()
+
+            if self.error is not None:
+                raise IOError(errno.EIO, "Retrieval of {0} failed: {1}".format(
+                    self.content_key, self.error))
+            if self.cache_file is not None:
+                return None
+
+            # Open file under lock: it's moved into cache when retrieval
+            # finishes.
+            f = open(self.partial_file_path, "rb")
+
+        with f:
+            f.seek(offset)
+            return f.read(end - offset)
+
+
+class RevisionDates(object):
+    """Index of revisions creation dates
+
+    Dates are stored in array indexed by revision number. Array is filled in
+    background as new revisions appear and is appended to file in cache
+    directory, so it's filled only once for repository.
+    """
+
+    # Number of revisions indexed between saves during initial filling
+    save_interval = 10000
+
+    def __init__(self, path, uuid, read_date):
+        self.path = path
+        self.uuid = uuid
+        # read_date(rev) -> revision date in seconds
+        self.read_date = read_date
+
+        self.dates = array.array("d")
+        self.lock = threading.Lock()
+        # Number of dates stored in file, None if file should be rewritten
+        self.saved = None
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                uuid = f.readline().rstrip("\n")
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        if uuid != self.uuid:
+            # Index of other repository
+            return
+
+        # Skip incompletely written tail
+        tail_size = len(data) % self.dates.itemsize
+        self.dates.fromstring(data[:len(data) - tail_size])
+        if tail_size == 0:
+            self.saved = len(self.dates)
+        # else: file will be rewritten on next save.
+
+    def save(self):
+        if self.saved is None:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(self.uuid + "\n")
+                self.dates.tofile(f)
+            os.rename(temp_path, self.path)
+        else:
+            with open(self.path, "ab") as f:
+                self.dates[self.saved:].tofile(f)
+        self.saved = len(self.dates)
+
+    def get(self, rev):
+        """Return date of revision in seconds"""
+        # Array only grows, so it's safe to read it without lock.
+        if rev < len(self.dates):
+            return self.dates[rev]
+
+        # Not indexed yet
+        return self.read_date(rev)
+
+    def find(self, date, youngest_rev):
+        """Return youngest revision created at or before date
+
+        Binary search is used, dates of not indexed yet revisions are read as
+        needed. Returns None if date precedes repository creation.
+        """
+        low, high = 0, youngest_rev + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.get(middle) <= date:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            return None
+        return low - 1
+
+    def fill(self, youngest_rev):
+        """Index dates of all revisions up to youngest_rev"""
+        with self.lock:
+            while len(self.dates) <= youngest_rev:
+                self.dates.append(self.read_date(len(self.dates)))
+                if len(self.dates) - (self.saved or 0) >= self.save_interval:
+                    self.save()
+
+            if self.saved != len(self.dates):
+                self.save()
+
+    def start(self, get_youngest_rev):
+        """Start filling index in background, should be called after FUSE daemonized"""
+        fill_thread = threading.Thread(target=self.__fill_thread, args=(get_youngest_rev,))
+        fill_thread.daemon = True
+        fill_thread.start()
+
+    def __fill_thread(self, get_youngest_rev):
+        while True:
+            try:
+                self.fill(get_youngest_rev())
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+            time.sleep(check_new_revision_time)
+
+
+class PathHistoryIndex(object):
+    """Index of revisions in which paths changed
+
+    Node at path stays the same in all revisions between changes of path,
+    so (path, rev) can be replaced with (path, revision of last change)
+    and caches entries are shared by all revisions of unchanged interval.
+
+    Node of file changes when file is changed, node of directory changes
+    also when anything inside it is changed. Nodes of all paths inside
+    directory change when directory is added, deleted or replaced.
+    """
+
+    def __init__(self, read_changes):
+        # read_changes(rev) -> list of (path, change_kind)
+        self.read_changes = read_changes
+
+        # path -> array of revisions in which path or anything inside
+        # it changed
+        self.changes = {}
+        # path -> array of revisions in which path was added, deleted or
+        # replaced
+        self.replacements = {}
+        # Revisions up to this one are indexed
+        self.indexed_rev = 0
+        self.lock = threading.Lock()
+
+    def __add(self, index, path, rev):
+        revs = index.get(path)
+        if revs is None:
+            revs = index[path] = array.array("i")
+        if len(revs) == 0 or revs[-1] != rev:
+            revs.append(rev)
+
+    def add_revision(self, rev, changes):
+        for path, change_kind in changes:
+            path = "/" + path.lstrip("/")
+
+            if change_kind != svn.fs.path_change_modify:
+                self.__add(self.replacements, path, rev)
+
+            while True:
+                self.__add(self.changes, path, rev)
+                if path == "/":
+                    break
+                path = posixpath.dirname(path)
+
+        self.indexed_rev = rev
+
+    def fill(self, youngest_rev):
+        """Index revisions up to youngest_rev"""
+        with self.lock:
+            for rev in xrange(self.indexed_rev + 1, youngest_rev + 1):
+                self.add_revision(rev, self.read_changes(rev))
+
+    @staticmethod
+    def __last_rev(revs, rev):
+        if revs is None:
+            return 0
+        # Arrays are only appended with revisions greater than indexed.
+        index = bisect.bisect_right(revs, rev)
+        if index == 0:
+            return 0
+        return revs[index - 1]
+
+    def canonical_rev(self, path, rev):
+        """Return revision in which node at path in rev was created
+
+        If rev is not indexed yet, it's returned as is.
+        """
+        if rev > self.indexed_rev:
+            return rev
+
+        canonical_rev = self.__last_rev(self.changes.get(path), rev)
+        while path != "/":
+            path = posixpath.dirname(path)
+            canonical_rev = max(canonical_rev, self.__last_rev(self.replacements.get(path), rev))
+
+        if canonical_rev == 0:
+            # Path never existed
+            return rev
+        return canonical_rev
+
+    def start(self, get_youngest_rev):
+        """Start indexing in background, should be called after FUSE daemonized"""
+        index_thread = threading.Thread(target=self.__index_thread, args=(get_youngest_rev,))
+        index_thread.daemon = True
+        index_thread.start()
+
+    def __index_thread(self, get_youngest_rev):
+        while True:
+            try:
+                self.fill(get_youngest_rev())
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+            time.sleep(check_new_revision_time)
+
+
+class FileWatcher(object):
+    """Watch for file changes using Linux inotify
+
+    File is replaced by renaming, so its directory is watched. callback() is
+    called from watcher thread on each change of file, stopped_callback() is
+    called if watching fails, so changes should be polled for instead.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, file_path, callback, stopped_callback=None):
+        self.dir_path, self.file_name = os.path.split(file_path)
+        self.callback = callback
+        self.stopped_callback = stopped_callback
+        self.fd = None
+
+    def start(self):
+        """Start watching, returns False if inotify is not available"""
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            return False
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init") or not hasattr(libc, "inotify_add_watch"):
+            return False
+
+        fd = libc.inotify_init()
+        if fd < 0:
+            return False
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, self.dir_path, mask) < 0:
+            os.close(fd)
+            return False
+
+        self.fd = fd
+        watcher_thread = threading.Thread(target=self.__watcher_thread)
+        watcher_thread.daemon = True
+        watcher_thread.start()
+        return True
+
+    def __watcher_thread(self):
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                traceback.print_exc()
+                sys.stderr.flush()
+                break
+
+            changed = False
+            offset = 0
+            while offset + self.event_header.size <= len(data):
+                wd, mask, cookie, name_len = self.event_header.unpack_from(data, offset)
+                offset += self.event_header.size
+                name = data[offset:offset + name_len].rstrip("\0")
+                offset += name_len
+
+                if name == self.file_name or mask & self.IN_Q_OVERFLOW:
+                    changed = True
+
+            if changed:
+                try:
+                    self.callback()
+                except Exception:
+                    traceback.print_exc()
+                    sys.stderr.flush()
+
+        os.close(self.fd)
+        self.fd = None
+        if self.stopped_callback is not None:
+            self.stopped_callback()
+
+
+class SignalWatcher(object):
+    """Call callback from separate thread when signal is received
+
+    Main thread is blocked in FUSE main loop and never runs Python signal
+    handlers. Instead C-level signal handler writes to wakeup file
+    descriptor, which is read by watcher thread.
+
+    install() should be called from main thread before FUSE main loop, so
+    FUSE doesn't install its own handler for the signal, and start() after
+    FUSE daemonized. Wakeup file descriptor is written for any signal
+    handled by Python, so callback may be called spuriously.
+    """
+
+    def __init__(self, signum, callback):
+        self.signum = signum
+        self.callback = callback
+        self.read_fd = None
+
+    def install(self):
+        read_fd, write_fd = os.pipe()
+        flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(write_fd)
+        # Python handler itself does nothing, it runs only after FUSE main
+        # loop exits.
+        signal.signal(self.signum, lambda signum, frame: None)
+        self.read_fd = read_fd
+
+    def start(self):
+        watcher_thread = threading.Thread(target=self.__watcher_thread)
+        watcher_thread.daemon = True
+        watcher_thread.start()
+
+    def __watcher_thread(self):
+        while True:
+            if not os.read(self.read_fd, 4096):
+                break
+
+            try:
+                self.callback()
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+
+class RevisionsWarmer(object):
+    """Warm caches up with paths changed in newly committed revisions
+
+    When youngest revision advances, metadata and listings of changed paths
+    and their parent directories are retrieved and contents of changed files
+    are retrieved into files cache. Work is done by bounded pool of threads
+    and only when files cache has no other retrievals queued, files are
+    retrieved with background priority.
+    """
+
+    def __init__(self, svnfs, prefix="/", max_file_size=None, threads_num=1):
+        self.svnfs = svnfs
+        self.prefix = "/" + prefix.strip("/")
+        self.max_file_size = max_file_size
+        self.threads_num = threads_num
+
+        self.queue = Queue.Queue()
+        # Set when youngest revision is known to be changed
+        self.head_changed = threading.Event()
+
+        self.warmed_paths = 0
+        self.warmed_files = 0
+
+    def start(self):
+        """Start warming up, should be called after FUSE daemonized"""
+        for _ in xrange(self.threads_num):
+            worker_thread = threading.Thread(target=self.__worker_thread)
+            worker_thread.daemon = True
+            worker_thread.start()
+
+        dispatcher_thread = threading.Thread(target=self.__dispatcher_thread)
+        dispatcher_thread.daemon = True
+        dispatcher_thread.start()
+
+    def is_warmed(self, path):
+        return (self.prefix == "/" or path == self.prefix or
+                path.startswith(self.prefix + "/"))
+
+    def __dispatcher_thread(self):
+        # Only revisions committed after start are warmed.
+        warmed_rev = self.svnfs.svnfs_youngest_rev()
+        while True:
+            try:
+                youngest_rev = self.svnfs.svnfs_youngest_rev()
+                for rev in xrange(warmed_rev + 1, youngest_rev + 1):
+                    self.dispatch_revision(rev)
+                warmed_rev = max(warmed_rev, youngest_rev)
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+            # Woken up immediately if repository is watched
+            self.head_changed.wait(check_new_revision_time)
+            self.head_changed.clear()
+
+    def dispatch_revision(self, rev):
+        """Queue paths changed in revision and their parent directories"""
+        pool = svn.core.Pool(get_pool())
+        root = self.svnfs.svnfs_get_root(rev, pool)
+
+        paths = set()
+        for path, change in svn.fs.paths_changed(root, pool).iteritems():
+            path = "/" + path.lstrip("/")
+            if change.change_kind == svn.fs.path_change_delete or not self.is_warmed(path):
+                continue
+
+            # Parent directories get new node revisions too.
+            while path not in paths:
+                paths.add(path)
+                if path == "/":
+                    break
+                path = posixpath.dirname(path)
+
+        # Parent directories first, sorted path precedes its children.
+        for path in sorted(paths):
+            self.queue.put((rev, path))
+
+    def __worker_thread(self):
+        while True:
+            rev, path = self.queue.get()
+
+            # Don't compete with retrievals requested by readers.
+            while not self.svnfs.files_cache.retrieval_queue.empty():
+                time.sleep(0.1)
+
+            try:
+                self.warm_path(rev, path)
+            except Exception:
+                traceback.print_exc()
+                sys.stderr.flush()
+
+    def warm_path(self, rev, path):
+        """Retrieve metadata, listing or contents of path into caches"""
+        try:
+            st = self.svnfs.svnfs_getattr(rev, path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        self.warmed_paths += 1
+
+        if stat.S_ISDIR(st.st_mode):
+            self.svnfs.svnfs_dir_entries(rev, path)
+        elif self.max_file_size is None or st.st_size <= self.max_file_size:
+            pool = svn.core.Pool(get_pool())
+            node_revision_id = self.svnfs.svnfs_lookup_node(rev, path)[1]
+            content_key = self.svnfs.svnfs_content_key(rev, path, node_revision_id, pool)
+            if self.svnfs.files_cache.get_file_path(content_key) is None:
+                # Waits until whole file is retrieved, readers' retrievals
+                # queued meanwhile are run first.
+                self.svnfs.svnfs_read(rev, path, content_key, 1, max(0, st.st_size - 1), pool,
+                                      background=True)
+                self.warmed_files += 1
 
 
 class SvnFSFileBase(object):
@@ -269,12 +2099,37 @@ class SvnFSFileBase(object):
 
         self.rev = rev
         self.path = path
-        self.node_revision_id = self.svnfs.svnfs_node_revision_id(rev, path, pool)
+        self.node_revision_id = self.svnfs.svnfs_lookup_node(rev, path)[1]
+        self.content_key = self.svnfs.svnfs_content_key(rev, path, self.node_revision_id, pool)
+        self.size = self.svnfs.svnfs_getattr(rev, path).st_size
+        self.svnfs.files_cache.pin(self.content_key)
+
+        # Cache file is opened once it's retrieved and kept opened until
+        # handle is released.
+        self.cache_reader = None
+        self.cache_reader_lock = threading.Lock()
 
     @trace_exceptions
     def read(self, length, offset):
+        if self.svnfs.contents_cache is not None and self.size <= self.svnfs.contents_cache_max_file_size:
+            contents = self.svnfs.svnfs_read_contents(self.rev, self.path, self.content_key, self.size,
+                                                      requester=self)
+            return contents[offset:offset + length]
+
+        if self.cache_reader is None:
+            with self.cache_reader_lock:
+                if self.cache_reader is None:
+                    self.cache_reader = self.svnfs.files_cache.open_file(self.content_key)
+
+        if self.cache_reader is not None:
+            # Cache file is opened once per handle, so following reads keep
+            # it recently used.
+            self.svnfs.files_cache.touch(self.content_key, access=False)
+            return self.cache_reader.read(length, offset)
+
         pool = svn.core.Pool(get_pool())
-        return self.svnfs.svnfs_read(self.rev, self.path, self.node_revision_id, length, offset, pool)
+        return self.svnfs.svnfs_read(self.rev, self.path, self.content_key, length, offset, pool,
+                                     requester=self)
 
     @trace_exceptions
     def write(self, buf, offset):
@@ -282,7 +2137,11 @@ class SvnFSFileBase(object):
 
     @trace_exceptions
     def release(self, flags):
-        pass
+        with self.cache_reader_lock:
+            if self.cache_reader is not None:
+                self.cache_reader.close()
+                self.cache_reader = None
+        self.svnfs.files_cache.unpin(self.content_key)
 
     @trace_exceptions
     def _fflush(self):
@@ -318,14 +2177,20 @@ class SvnFSAllRevisionsFile(SvnFSFileBase):
         if not m:
             raise_no_such_entry_error("Path not found: {0}".format(path))
 
+        if m.group(1) == 'head' or m.group(1).startswith('@'):
+            # Same path refers to different contents when new revision is
+            # committed, don't let kernel keep previously read contents.
+            self.keep_cache = False
+
         pool = svn.core.Pool(get_pool())
         rev = self.svnfs.svnfs_get_rev(m.group(1))
         if rev > self.svnfs.svnfs_youngest_rev():
             raise_no_such_entry_error("Nonexistent (yet) revision {0}".format(rev))
 
         svn_path = m.group(2)
+        rev = self.svnfs.svnfs_canonical_rev(rev, svn_path)
 
-        if not self.svnfs.svnfs_file_exists(rev, svn_path, pool):
+        if self.svnfs.svnfs_lookup_node(rev, svn_path)[0] == svn.core.svn_node_none:
             raise_no_such_entry_error("Path not found in {0} revision: {1}".format(rev, svn_path))
 
         self.svnfs_init(rev, svn_path, pool)
@@ -338,12 +2203,25 @@ class SvnFSSingleRevisionFile(SvnFSFileBase):
 
         pool = svn.core.Pool(get_pool())
 
-        if not self.svnfs.svnfs_file_exists(self.svnfs.rev, path, pool):
+        if self.svnfs.svnfs_lookup_node(self.svnfs.rev, path)[0] == svn.core.svn_node_none:
             raise_no_such_entry_error("Path not found in {0} revision: {1}".format(self.svnfs.rev, path))
 
         self.svnfs_init(self.svnfs.rev, path, pool)
 
 
+class SvnFSDirHandle(object):
+    """State of opened directory
+
+    Listing is kept for the whole opendir()/readdir()/releasedir() sequence,
+    so paging through huge directory, which listing doesn't fit into
+    listings cache, doesn't retrieve and sort it again for each page.
+    """
+    def __init__(self, path):
+        self.path = path
+        # List of (name, kind, node_revision_id), retrieved on first read
+        self.entries = None
+
+
 class FuseReadOnlyMixin(object):
     @trace_exceptions
     def unlink(self, path):
@@ -410,6 +2288,22 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
         self.logfile = None
         self.send_sigstop = None
         self.cache_dir = None
+        self.cache_max_bytes = None
+        self.cache_eviction = "lru"
+        self.cache_compression = False
+        self.contents_cache_bytes = 64 * 1024 ** 2
+        self.contents_cache_max_file_size = 64 * 1024
+        self.dir_listings_cache_bytes = 16 * 1024 ** 2
+        self.attr_cache_bytes = 32 * 1024 ** 2
+        self.metadata_max_entries = 1000000
+        self.config = None
+        self.config_watcher = None
+        self.immutable_cache_timeout = 3600.0
+        self.path_history_index = False
+        self.warm = False
+        self.warm_prefix = "/"
+        self.warm_max_file_size = 16 * 1024 ** 2
+        self.warm_threads = 1
 
     # TODO: exceptions here not handled properly, so output them manually
     @trace_exceptions
@@ -425,18 +2319,131 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
             if self.uid is not None:
                 os.setuid(self.uid)
 
+            self.files_cache.start()
+
+            if self.config_watcher is not None:
+                self.config_watcher.start()
+
+            # FSFS repository updates db/current file when revision is
+            # committed, watch it instead of polling if possible.
+            current_path = os.path.join(self.repospath, "db", "current")
+            if os.path.exists(current_path):
+                head_watcher = FileWatcher(current_path, self.svnfs_head_changed, self.svnfs_head_unwatched)
+                if head_watcher.start():
+                    # Read after watch is added, so no commit is missed.
+                    self.svnfs_head_changed()
+
+            self.revision_dates.start(self.svnfs_youngest_rev)
+
+            if self.path_history is not None:
+                self.path_history.start(self.svnfs_youngest_rev)
+
+            if self.warmer is not None:
+                self.warmer.start()
+
         finally:
             if self.send_sigstop:
                 os.kill(os.getpid(), signal.SIGSTOP)
 
+    @trace_exceptions
+    def fsdestroy(self):
+        self.files_cache.close()
+
+        if self.logfile is not None:
+            self.svnfs_write_statistics()
+
+    def svnfs_write_statistics(self):
+        sys.stdout.write("Statistics at {0}:\n".format(str(datetime.datetime.now())))
+        sys.stdout.write("  Files cache: {0} duplicate fetches avoided\n".format(
+            self.files_cache.duplicate_fetches_avoided))
+        sys.stdout.write("  Files cache: {0} bytes used, {1} files evicted\n".format(
+            self.files_cache.total_size, self.files_cache.evictions))
+        sys.stdout.write("  Files cache: {0} node revisions share {1} cached contents\n".format(
+            len(self.files_cache.nodes_db), len(self.files_cache.cache_db)))
+        sys.stdout.write("  Files cache: {0} broken entries repaired\n".format(
+            self.files_cache.repaired_entries))
+        if self.warmer is not None:
+            sys.stdout.write("  Warmer: {0} paths warmed, {1} files retrieved\n".format(
+                self.warmer.warmed_paths, self.warmer.warmed_files))
+        if self.path_history is not None:
+            sys.stdout.write("  Path history index: {0} revisions, {1} paths\n".format(
+                self.path_history.indexed_rev, len(self.path_history.changes)))
+        sys.stdout.write("  Revision dates index: {0} revisions\n".format(len(self.revision_dates.dates)))
+        sys.stdout.write("  Negative lookups cache: {0} lookups absorbed\n".format(
+            self.negative_lookups_absorbed))
+        sys.stdout.write("  Metadata cache: {0} hits, {1} misses, {2} node revisions stored, {3} pruned\n".format(
+            self.metadata_hits, self.metadata_misses, len(self.files_cache.metadata_db),
+            self.files_cache.pruned_metadata))
+        if self.contents_cache is not None:
+            sys.stdout.write("  Contents memory cache: {0} hits, {1} misses, {2} bytes used\n".format(
+                self.contents_cache.hits, self.contents_cache.misses, self.contents_cache.total_bytes))
+        sys.stdout.write("  Directory listings cache: {0} hits, {1} misses, {2} bytes used\n".format(
+            self.dir_listings_cache.hits, self.dir_listings_cache.misses, self.dir_listings_cache.total_bytes))
+        sys.stdout.write("  Attributes caches: {0} bytes used\n".format(
+            sum(cache.total_bytes for cache in self.__attr_caches())))
+        sys.stdout.flush()
+
+    def __attr_caches(self):
+        return [self.svnfs_getattr.cache, self.__getattr_rev.cache, self.lookup_cache, self.negative_cache,
+                self.files_cache.metadata_cache, self.files_cache.content_keys_cache]
+
+    def svnfs_configure_caches(self):
+        """Size in-memory caches according to their budgets in bytes
+
+        Called on initialization and when configuration is reloaded, cached
+        entries are kept as long as they fit.
+        """
+        self.files_cache.resize(self.cache_max_bytes, self.metadata_max_entries)
+
+        if self.contents_cache_bytes > 0:
+            contents_cache_size = max(1, self.contents_cache_bytes // contents_cache_average_file_size)
+            if self.contents_cache is None:
+                self.contents_cache = LRUCache(contents_cache_size, max_bytes=self.contents_cache_bytes)
+            else:
+                self.contents_cache.resize(contents_cache_size, self.contents_cache_bytes)
+        elif self.contents_cache is not None:
+            # Cache may be in use by readers, so it's emptied instead of
+            # being removed.
+            self.contents_cache.resize(1, 0)
+
+        self.dir_listings_cache.resize(
+            max(1, self.dir_listings_cache_bytes // dir_listings_cache_average_size),
+            max(1, self.dir_listings_cache_bytes))
+
+        shares = [getattr_cache_share, getattr_rev_cache_share, lookup_cache_share, negative_cache_share,
+                  metadata_cache_share, content_keys_cache_share]
+        for cache, share in zip(self.__attr_caches(), shares):
+            max_bytes = max(1, int(self.attr_cache_bytes * share))
+            cache.resize(max(1, max_bytes // attr_cache_entry_size), max_bytes)
+
+    def svnfs_reload_config(self):
+        """Re-read configuration file and apply new caches budgets"""
+        try:
+            options = read_config_file(self.config)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("Configuration reloading failed: {0}\n".format(str(e)))
+            sys.stderr.flush()
+            return
+
+        for name, value in options.iteritems():
+            setattr(self, name, value)
+        self.svnfs_configure_caches()
+
+        sys.stdout.write("Configuration reloaded at {0}\n".format(str(datetime.datetime.now())))
+        sys.stdout.flush()
+
     def init_repo(self):
         # Called from main thread before daemonizing.
         assert self.repospath is not None
 
         pool = get_pool()
 
+        # Youngest revision is tracked by watcher when it's available,
+        # otherwise it's polled.
+        self.watched_youngest_rev = None
+
         # Try to open repository
-        svn.repos.svn_repos_fs(
+        fs_ptr = svn.repos.svn_repos_fs(
             svn.repos.svn_repos_open(
                 svn.core.svn_path_canonicalize(self.repospath, pool), pool))
 
@@ -450,9 +2457,45 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
             self.file_class = SvnFSAllRevisionsFile
         self.file_class.svnfs = self
 
-        self.files_cache = FilesCache(self.cache_dir)
+        self.files_cache = FilesCache(self.cache_dir, self.cache_max_bytes, self.cache_eviction,
+                                      self.cache_compression, self.__legacy_content_key,
+                                      self.metadata_max_entries)
+
+        # Created by svnfs_configure_caches() if it's enabled.
+        self.contents_cache = None
+
+        # Directory node revisions are immutable, so listings are cached by
+        # node revision id and shared by all revisions.
+        self.dir_listings_cache = LRUCache(1, max_bytes=1, sizeof=dir_listing_size)
 
         self.fs_ptrs = {}
+        self.local = threading.local()
+
+        self.revision_dates = RevisionDates(os.path.join(self.cache_dir, "revision_dates"),
+                                            svn.fs.get_uuid(fs_ptr, pool),
+                                            self.__revision_creation_time)
+
+        if self.path_history_index and self.revision == 'all':
+            self.path_history = PathHistoryIndex(self.__read_changes)
+        else:
+            self.path_history = None
+
+        if self.warm and self.revision == 'all':
+            self.warmer = RevisionsWarmer(self, self.warm_prefix, self.warm_max_file_size,
+                                          self.warm_threads)
+        else:
+            self.warmer = None
+
+        self.metadata_hits = 0
+        self.metadata_misses = 0
+
+        # (rev, path) -> (kind, node_revision_id) of existing paths
+        self.lookup_cache = SLRUCache(getattr_lru_cache_size, sizeof=lookup_entry_size)
+        # (rev, path) of nonexistent paths
+        self.negative_cache = LRUCache(negative_cache_size, sizeof=attr_entry_size)
+        self.negative_lookups_absorbed = 0
+
+        self.svnfs_configure_caches()
 
     def __get_fs_ptr(self):
         # Use thread pool.
@@ -475,72 +2518,207 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
     #    if not os.access("." + path, mode):
     #        return -EACCES
 
-    def __revision_creation_time(self, rev, pool):
+    def __revision_creation_time(self, rev):
+        pool = svn.core.Pool(get_pool())
         date = svn.fs.revision_prop(self.fs_ptr, rev,
             svn.core.SVN_PROP_REVISION_DATE, pool)
         return svn.core.secs_from_timestr(date, pool)
 
     def svnfs_get_root(self, rev, pool):
-        return svn.fs.revision_root(self.fs_ptr, rev, pool)
+        """Return revision root
+
+        Revision roots are immutable and cache resolved nodes, so recently
+        used roots are kept opened per thread, each in it's own pool.
+        """
+        roots = getattr(self.local, "roots", None)
+        if roots is None:
+            roots = self.local.roots = LRUCache(revision_roots_per_thread)
+
+        root_pool, root = roots.get(rev, (None, None))
+        if root is None:
+            root_pool = svn.core.Pool(get_pool())
+            root = svn.fs.revision_root(self.fs_ptr, rev, root_pool)
+            roots.put(rev, (root_pool, root))
+
+        return root
+
+    def svnfs_lookup_node(self, rev, path):
+        """Resolve path in revision
+
+        Returns (kind, node_revision_id), kind is svn_node_none and
+        node_revision_id is None if nothing is found at path.
+        """
+        key = (rev, path)
+        result = self.lookup_cache.get(key)
+        if result is not None:
+            return result
+
+        # Missing paths are cached separately, so probes of nonexistent
+        # paths don't evict resolved ones. Paths under "/head" are looked up
+        # by numeric revision, so their misses stop matching when youngest
+        # revision changes.
+        if (self.negative_cache.get(key) is not None or
+                (path != "/" and self.negative_cache.get((rev, posixpath.dirname(path))) is not None)):
+            self.negative_lookups_absorbed += 1
+            return svn.core.svn_node_none, None
+
+        result = self.__resolve_node(rev, path)
+        if result[0] == svn.core.svn_node_none:
+            self.negative_cache.put(key, True)
+        else:
+            self.lookup_cache.put(key, result)
+        return result
 
-    def svnfs_file_exists(self, rev, svn_path, pool):
-        root = self.svnfs_get_root(rev, pool)
-        kind = svn.fs.check_path(root, svn_path, pool)
-        return kind != svn.core.svn_node_none
+    def __resolve_node(self, rev, path):
+        pool = svn.core.Pool(get_pool())
 
-    def svnfs_node_revision_id(self, rev, path, pool):
         root = self.svnfs_get_root(rev, pool)
-        node_id = svn.fs.node_id(root, path, pool)
-        return svn.fs.unparse_id(node_id, pool)
+        kind = svn.fs.check_path(root, path, pool)
+        if kind == svn.core.svn_node_none:
+            return kind, None
 
-    @lru_cache(getattr_lru_cache_size)
-    def svnfs_getattr(self, rev, path):
-        pool = svn.core.Pool(get_pool())
+        # Path is resolved already, lookup is served by root's nodes cache.
+        node_revision_id = svn.fs.unparse_id(svn.fs.node_id(root, path, pool), pool)
+        return kind, node_revision_id
 
-        st = fuse.Stat()
+    def svnfs_node_created_rev(self, rev, path, node_revision_id, pool):
+        m = node_revision_id_rev_re.search(node_revision_id)
+        if m:
+            return int(m.group(1))
 
+        # Not FSFS repository
         root = self.svnfs_get_root(rev, pool)
+        return svn.fs.node_created_rev(root, path, pool)
+
+    def svnfs_content_key(self, rev, path, node_revision_id, pool):
+        """Return key of file contents in files cache
+
+        Key is contents checksum, so node revisions with same contents share
+        one cache file.
+        """
+        content_key = self.files_cache.get_content_key(node_revision_id)
+        if content_key is None:
+            root = self.svnfs_get_root(rev, pool)
+            content_key = self.__checksum_content_key(root, path, pool)
+            self.files_cache.put_content_key(node_revision_id, content_key)
+
+        return content_key
+
+    def __checksum_content_key(self, root, path, pool):
+        # SHA-1 checksum is not stored for old representations, don't
+        # force calculating it, MD5 checksum is always stored.
+        checksum = svn.fs.file_checksum(svn.core.svn_checksum_sha1, root, path, False, pool)
+        if checksum is not None:
+            kind = "sha1"
+        else:
+            checksum = svn.fs.file_checksum(svn.core.svn_checksum_md5, root, path, True, pool)
+            kind = "md5"
 
-        kind = svn.fs.check_path(root, path, pool)
+        return "{0}-{1}".format(kind, svn.core.svn_checksum_to_cstring_display(checksum, pool))
+
+    def __legacy_content_key(self, node_revision_id):
+        """Find content key of node revision cached by previous cache version
+
+        Node revision is created in revision which is part of its id, at one
+        of paths changed in that revision. Returns None if it's not found.
+        """
+        m = node_revision_id_rev_re.search(node_revision_id)
+        if m is None:
+            return None
+
+        pool = svn.core.Pool(get_pool())
+        root = self.svnfs_get_root(int(m.group(1)), pool)
+        for path, change in svn.fs.paths_changed(root, pool).iteritems():
+            if change.change_kind == svn.fs.path_change_delete:
+                continue
+            if svn.fs.check_path(root, path, pool) != svn.core.svn_node_file:
+                continue
+            if svn.fs.unparse_id(svn.fs.node_id(root, path, pool), pool) == node_revision_id:
+                return self.__checksum_content_key(root, path, pool)
+
+        return None
+
+    @lru_cache(getattr_lru_cache_size, policy="slru", sizeof=attr_entry_size, single_flight=True)
+    def svnfs_getattr(self, rev, path):
+        pool = svn.core.Pool(get_pool())
+
+        kind, node_revision_id = self.svnfs_lookup_node(rev, path)
         if kind == svn.core.svn_node_none:
             e = OSError("Nothing found at {0}".format(path))
             e.errno = errno.ENOENT
             raise e
 
+        # Node revisions never change, so their metadata is stored in
+        # persistent index and shared by all revisions.
+        metadata = self.files_cache.get_metadata(node_revision_id)
+        if metadata is None:
+            created_rev = self.svnfs_node_created_rev(rev, path, node_revision_id, pool)
+            metadata = dict(mtime=self.revision_dates.get(created_rev))
+            if kind == svn.core.svn_node_dir:
+                metadata["size"] = 512
+            else:
+                root = self.svnfs_get_root(rev, pool)
+                metadata["size"] = svn.fs.file_length(root, path, pool)
+            self.files_cache.put_metadata(node_revision_id, metadata)
+            self.metadata_misses += 1
+        else:
+            self.metadata_hits += 1
+
+        return self.__node_stat(kind, node_revision_id, metadata)
+
+    def __node_stat(self, kind, node_revision_id, metadata):
+        st = fuse.Stat()
+
         # TODO: CRC of some id?
-        st.st_ino = svn.fs.unparse_id(svn.fs.node_id(root, path, pool), pool)
-        st.st_ino = abs(binascii.crc32(st.st_ino))
+        st.st_ino = node_ino(node_revision_id)
 
-        st.st_size = 0
         st.st_dev = 0
         st.st_nlink = 1
         st.st_uid = 0
         st.st_gid = 0
 
-        created_rev = svn.fs.node_created_rev(root, path, pool)
-        time = self.__revision_creation_time(created_rev, pool)
-        st.st_mtime = time
-        st.st_ctime = time
-        st.st_atime = time
+        st.st_mtime = metadata["mtime"]
+        st.st_ctime = metadata["mtime"]
+        st.st_atime = metadata["mtime"]
+        st.st_size = metadata["size"]
 
         if kind == svn.core.svn_node_dir:
             st.st_mode = stat.S_IFDIR | 0o555
-            st.st_size = 512
         else:
             st.st_mode = stat.S_IFREG | 0o444
-            st.st_size = svn.fs.file_length(root, path, pool)
 
         return st
 
-    @lru_cache(1, timeout=check_new_revision_time)
     def svnfs_youngest_rev(self):
+        rev = self.watched_youngest_rev
+        if rev is not None:
+            return rev
+
+        return self.__poll_youngest_rev()
+
+    @lru_cache(1, timeout=check_new_revision_time, stale_while_revalidate=check_new_revision_time)
+    def __poll_youngest_rev(self):
         pool = svn.core.Pool(get_pool())
         return svn.fs.youngest_rev(self.fs_ptr, pool)
 
-    @lru_cache(1, timeout=check_new_revision_time)
-    def __getattr_root(self):
+    def svnfs_head_changed(self):
+        """Update youngest revision, called by repository watcher"""
         pool = svn.core.Pool(get_pool())
+        self.watched_youngest_rev = svn.fs.youngest_rev(self.fs_ptr, pool)
+
+        # Invalidate only HEAD-dependent entries, "/head/..." paths are
+        # resolved to numeric revisions before caches lookups.
+        self.__getattr_root.cache.invalidate((self,))
+
+        if self.warmer is not None:
+            self.warmer.head_changed.set()
+
+    def svnfs_head_unwatched(self):
+        """Fall back to polling of youngest revision, called when repository watcher fails"""
+        self.watched_youngest_rev = None
 
+    @lru_cache(1, timeout=check_new_revision_time, stale_while_revalidate=check_new_revision_time)
+    def __getattr_root(self):
         st = fuse.Stat()
 
         rev = self.svnfs_youngest_rev()
@@ -553,7 +2731,7 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
         st.st_uid = 0
         st.st_gid = 0
 
-        time = self.__revision_creation_time(rev, pool)
+        time = self.revision_dates.get(rev)
         st.st_mtime = time
         st.st_ctime = time
         st.st_atime = time
@@ -563,10 +2741,8 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
 
         return st
 
-    @lru_cache(getattr_rev_lru_cache_size)
+    @lru_cache(getattr_rev_lru_cache_size, policy="slru", sizeof=attr_entry_size, single_flight=True)
     def __getattr_rev(self, rev):
-        pool = svn.core.Pool(get_pool())
-
         st = fuse.Stat()
 
         st.st_ino = 0
@@ -577,7 +2753,7 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
         st.st_uid = 0
         st.st_gid = 0
 
-        time = self.__revision_creation_time(rev, pool)
+        time = self.revision_dates.get(rev)
         st.st_mtime = time
         st.st_ctime = time
         st.st_atime = time
@@ -601,7 +2777,7 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
             if m:
                 rev = self.svnfs_get_rev(m.group(1))
                 svn_path = m.group(2)
-                return self.svnfs_getattr(rev, svn_path)
+                return self.svnfs_getattr(self.svnfs_canonical_rev(rev, svn_path), svn_path)
         else:
             return self.svnfs_getattr(self.rev, path)
 
@@ -609,9 +2785,31 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
         e.errno = errno.ENOENT
         raise e
 
+    def svnfs_canonical_rev(self, rev, path):
+        """Return earliest revision with the same node at path as in rev"""
+        if self.path_history is None:
+            return rev
+        return self.path_history.canonical_rev(path, rev)
+
+    def __read_changes(self, rev):
+        pool = svn.core.Pool(get_pool())
+        root = self.svnfs_get_root(rev, pool)
+        return [(path, change.change_kind) for path, change in svn.fs.paths_changed(root, pool).iteritems()]
+
     def svnfs_get_rev(self, rev):
         if rev == 'head':
             return self.svnfs_youngest_rev()
+        elif rev.startswith('@'):
+            # Resolved revision shares all caches with numeric revision
+            # directory.
+            date = parse_revision_date(rev[1:])
+            if date is None:
+                raise_no_such_entry_error("Invalid revision date: {0}".format(rev[1:]))
+
+            resolved_rev = self.revision_dates.find(date, self.svnfs_youngest_rev())
+            if resolved_rev is None:
+                raise_no_such_entry_error("No revisions before {0}".format(rev[1:]))
+            return resolved_rev
         else:
             return int(rev)
 
@@ -622,31 +2820,100 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
         e.errno = errno.ENOENT
         raise e
 
-    def __get_files_list_svn(self, root, path, pool):
-        # TODO: check that directory exists first?
-        return svn.fs.dir_entries(root, path, pool).keys()
+    def svnfs_dir_entries(self, rev, path):
+        """Return directory entries as list of (name, kind, node_revision_id)"""
+        kind, node_revision_id = self.svnfs_lookup_node(rev, path)
+        if kind == svn.core.svn_node_none:
+            raise_no_such_entry_error("Nothing found at {0}".format(path))
+        elif kind != svn.core.svn_node_dir:
+            e = ManagedOSError("Not a directory: {0}".format(path))
+            e.errno = errno.ENOTDIR
+            raise e
 
-    def __get_files_list(self, path, pool):
+        entries = self.dir_listings_cache.get(node_revision_id)
+        if entries is None:
+            pool = svn.core.Pool(get_pool())
+            root = self.svnfs_get_root(rev, pool)
+            # Sorted to keep entries order stable for readdir() offsets
+            entries = [(name, dirent.kind, svn.fs.unparse_id(dirent.id, pool))
+                       for name, dirent in sorted(svn.fs.dir_entries(root, path, pool).iteritems())]
+            self.dir_listings_cache.put(node_revision_id, entries)
+
+        return entries
+
+    def __prefill_attributes(self, rev, path, entries):
+        """Put attributes of directory entries into caches in one batch
+
+        Listing of directory is usually followed by getattr of each entry,
+        entries are already resolved, so they are not looked up again.
+        Metadata found in memory is reused, metadata of other entries is
+        calculated from directory revision root: modification time is date
+        of revision in node revision id and size is file length.
+        """
+        pool = svn.core.Pool(get_pool())
+        root = None
+        lookups = []
+        attributes = []
+        for name, kind, node_revision_id in entries:
+            entry_path = posixpath.join(path, name)
+            entry_rev = self.svnfs_canonical_rev(rev, entry_path)
+            lookups.append(((entry_rev, entry_path), (kind, node_revision_id)))
+
+            # Index in database isn't looked up, calculation is cheaper.
+            metadata = self.files_cache.metadata_cache.get(node_revision_id)
+            if metadata is None:
+                created_rev = self.svnfs_node_created_rev(rev, entry_path, node_revision_id, pool)
+                metadata = dict(mtime=self.revision_dates.get(created_rev))
+                if kind == svn.core.svn_node_dir:
+                    metadata["size"] = 512
+                else:
+                    if root is None:
+                        root = self.svnfs_get_root(rev, pool)
+                    metadata["size"] = svn.fs.file_length(root, entry_path, pool)
+                self.files_cache.put_metadata(node_revision_id, metadata)
+
+            attributes.append(((self, entry_rev, entry_path), self.__node_stat(kind, node_revision_id, metadata)))
+
+        self.lookup_cache.put_many(lookups)
+        self.svnfs_getattr.cache.put_many(attributes)
+
+    def __iter_files_list_svn(self, rev, path, start, dir_handle=None):
+        if dir_handle is not None and dir_handle.entries is not None:
+            entries = dir_handle.entries
+        else:
+            entries = self.svnfs_dir_entries(rev, path)
+            if dir_handle is not None:
+                dir_handle.entries = entries
+        if start == 0:
+            self.__prefill_attributes(rev, path, entries)
+
+        for i in xrange(start, len(entries)):
+            name, kind, node_revision_id = entries[i]
+            yield fuse.Direntry(name, type=node_kind_mode[kind], ino=node_ino(node_revision_id))
+
+    def __iter_files_list(self, path, start, dir_handle=None):
+        """Return iterator over fuse.Direntry of directory
+
+        Iteration starts from entry with start index, entries order is
+        stable. Listing is kept in dir_handle if it's specified.
+        """
         if self.revision == 'all':
             if path == "/":
                 rev = self.svnfs_youngest_rev()
-                return map(str, range(1, rev + 1))
+                return (fuse.Direntry(str(r), type=stat.S_IFDIR) for r in xrange(start + 1, rev + 1))
 
             m = revision_dir_re.match(path)
             if m:
                 rev = self.svnfs_get_rev(m.group(1))
-                root = self.svnfs_get_root(rev, pool)
-                return self.__get_files_list_svn(root, "/", pool)
+                return self.__iter_files_list_svn(self.svnfs_canonical_rev(rev, "/"), "/", start, dir_handle)
 
             m = file_re.match(path)
             if m:
                 rev = self.svnfs_get_rev(m.group(1))
                 path = m.group(2)
-                root = self.svnfs_get_root(rev, pool)
-                return self.__get_files_list_svn(root, path, pool)
+                return self.__iter_files_list_svn(self.svnfs_canonical_rev(rev, path), path, start, dir_handle)
         else:
-            root = self.svnfs_get_root(self.rev, pool)
-            return self.__get_files_list_svn(root, path, pool)
+            return self.__iter_files_list_svn(self.rev, path, start, dir_handle)
 
         e = OSError("Nothing found at {0}".format(path))
         e.errno = errno.ENOENT
@@ -654,49 +2921,77 @@ class SvnFS(Fuse, FuseReadOnlyMixin):
 
     @trace_exceptions
     def getdir(self, path):
-        pool = svn.core.Pool(get_pool())
-        return map(lambda x: (x, 0), self.__get_files_list(path, pool))
+        return [(entry.name, 0) for entry in self.__iter_files_list(path, 0)]
 
     @trace_exceptions
-    def readdir(self, path, offset):
-        # TODO: offset?
-
-        pool = svn.core.Pool(get_pool())
+    def opendir(self, path):
+        return SvnFSDirHandle(path)
 
-        if path == '/':
-            yield fuse.Direntry('head')
+    @trace_exceptions
+    def releasedir(self, path, dir_handle=None):
+        if dir_handle is not None:
+            dir_handle.entries = None
 
-        for f in  self.__get_files_list(path, pool) + [".", ".."]:
-            yield fuse.Direntry(f)
+    @trace_exceptions
+    def readdir(self, path, offset, dir_handle=None):
+        # Offset of entry is index of next entry, so FUSE can continue
+        # listing from any entry when its buffer is full, and listing is
+        # never built as a whole.
+        special_entries = [".", ".."]
+        if self.revision == 'all' and path == '/':
+            special_entries.append("head")
+
+        for index in xrange(offset, len(special_entries)):
+            yield fuse.Direntry(special_entries[index], type=stat.S_IFDIR, offset=index + 1)
+
+        index = max(offset, len(special_entries))
+        for entry in self.__iter_files_list(path, index - len(special_entries), dir_handle):
+            index += 1
+            entry.offset = index
+            yield entry
 
     @trace_exceptions
     def utime(self, path, times):
         return os.utime(path, times)
 
-    def svnfs_read(self, rev, path, node_revision_id, length, offset, pool):
-        cache_file = self.files_cache.get_file_path(node_revision_id)
-
-        if not cache_file:
-            # File not cached - get it and cache it
-            src_stream = svn.fs.file_contents(self.svnfs_get_root(rev, pool), path, pool)
-            with tempfile.NamedTemporaryFile(dir=self.files_cache.cache_temp_dir, delete=False) as destf:
-                temp_file_name = destf.name
-
-                bs = 4096 * 1024
-                while True:
-                    block = svn.core.svn_stream_read(src_stream, bs)
-                    if len(block) == 0:
-                        break
-                    destf.write(block)
+    def __retrieve_file_contents(self, rev, path, offset):
+        # Called from files cache retrieval thread
+        pool = svn.core.Pool(get_pool())
 
+        # Root is referenced until retrieval is finished, so it's not freed
+        # if evicted from roots cache meanwhile.
+        root = self.svnfs_get_root(rev, pool)
+        src_stream = svn.fs.file_contents(root, path, pool)
+        try:
+            while offset > 0:
+                # Resuming retrieval
+                skipped = len(svn.core.svn_stream_read(src_stream, min(offset, retrieve_block_size)))
+                if skipped == 0:
+                    break
+                offset -= skipped
+
+            while True:
+                block = svn.core.svn_stream_read(src_stream, retrieve_block_size)
+                if len(block) == 0:
+                    break
+                yield block
+        finally:
             svn.core.svn_stream_close(src_stream)
 
-            cache_file = self.files_cache.put_file(node_revision_id, temp_file_name)
-
-        # File contents already cached
-        with open(cache_file, "rb") as f:
-            f.seek(offset)
-            return f.read(length)
+    def svnfs_read_contents(self, rev, path, content_key, size, requester=None):
+        """Return whole contents of small file, cached in memory"""
+        contents = self.contents_cache.get(content_key)
+        if contents is None:
+            pool = svn.core.Pool(get_pool())
+            contents = self.svnfs_read(rev, path, content_key, size, 0, pool, requester=requester)
+            self.contents_cache.put(content_key, contents)
+        return contents
+
+    def svnfs_read(self, rev, path, content_key, length, offset, pool, requester=None, background=False):
+        size = self.svnfs_getattr(rev, path).st_size
+        retrieve = functools.partial(self.__retrieve_file_contents, rev, path)
+        return self.files_cache.read_file(content_key, size, retrieve, length, offset,
+                                          requester=requester, background=background)
 
     @trace_exceptions
     def statfs(self):
@@ -732,6 +3027,50 @@ def main():
         help="send SIGSTOP signal when file system is initialized (useful with -f)")
     svnfs.parser.add_option(mountopt="cache_dir", dest="cache_dir", default=os.curdir, metavar="PATH-TO-CACHE",
         help="use file cache for retrieved Subversion objects [default: %default]")
+    svnfs.parser.add_option(mountopt="cache_max_bytes", dest="cache_max_bytes", metavar="SIZE",
+        help="maximum size of file cache, K, M and G suffixes are allowed [default: unlimited]")
+    svnfs.parser.add_option(mountopt="cache_eviction", dest="cache_eviction", default="lru", metavar="POLICY",
+        help="files cache eviction policy: 'lru' or 'lfu' [default: %default]")
+    svnfs.parser.add_option(mountopt="cache_compression", dest="cache_compression",
+        action="store_true",
+        help="store compressible files in files cache compressed")
+    svnfs.parser.add_option(mountopt="contents_cache_bytes", dest="contents_cache_bytes", default="64M",
+        metavar="SIZE",
+        help="size of in-memory cache of small files contents, 0 disables it [default: %default]")
+    svnfs.parser.add_option(mountopt="contents_cache_max_file_size", dest="contents_cache_max_file_size",
+        default="64K", metavar="SIZE",
+        help="maximum size of file cached in memory [default: %default]")
+    svnfs.parser.add_option(mountopt="dir_listings_cache_bytes", dest="dir_listings_cache_bytes",
+        default="16M", metavar="SIZE",
+        help="size of in-memory cache of directory listings [default: %default]")
+    svnfs.parser.add_option(mountopt="attr_cache_bytes", dest="attr_cache_bytes",
+        default="32M", metavar="SIZE",
+        help="size of in-memory caches of paths lookups and attributes [default: %default]")
+    svnfs.parser.add_option(mountopt="metadata_max_entries", dest="metadata_max_entries",
+        default=1000000, type="int", metavar="NUM",
+        help="maximum number of node revisions which metadata and content keys are stored in files "
+             "cache index [default: %default]")
+    svnfs.parser.add_option(mountopt="config", dest="config", metavar="PATH-TO-CONFIG",
+        help="file with cache size options in 'name = value' lines, reloaded on SIGHUP")
+    svnfs.parser.add_option(mountopt="immutable_cache_timeout", dest="immutable_cache_timeout",
+        default=3600.0, type="float", metavar="SECONDS",
+        help="kernel entries and attributes cache timeout, applied only in single revision mode: "
+             "python-fuse can't set timeouts per entry, so in all revisions mode immutable /NNN/ "
+             "paths get FUSE default timeouts as '/' and '/head' do [default: %default]")
+    svnfs.parser.add_option(mountopt="path_history_index", dest="path_history_index",
+        action="store_true",
+        help="index paths history to share cached attributes of unchanged paths between revisions")
+    svnfs.parser.add_option(mountopt="warm", dest="warm",
+        action="store_true",
+        help="warm caches up with paths changed in new revisions")
+    svnfs.parser.add_option(mountopt="warm_prefix", dest="warm_prefix", default="/", metavar="PATH",
+        help="warm up only paths under this path [default: %default]")
+    svnfs.parser.add_option(mountopt="warm_max_file_size", dest="warm_max_file_size", default="16M",
+        metavar="SIZE",
+        help="maximum size of file retrieved by warm up [default: %default]")
+    svnfs.parser.add_option(mountopt="warm_threads", dest="warm_threads", default=1, type="int",
+        metavar="NUM",
+        help="number of warm up threads [default: %default]")
 
     svnfs.parse(values=svnfs, errex=1)
 
@@ -764,6 +3103,59 @@ def main():
                 svnfs.cache_dir = os.curdir
             svnfs.cache_dir = os.path.abspath(svnfs.cache_dir)
 
+            if svnfs.cache_max_bytes is not None:
+                try:
+                    svnfs.cache_max_bytes = parse_size(svnfs.cache_max_bytes)
+                except ValueError:
+                    sys.stderr.write("Error: Invalid maximum cache size.\n")
+                    sys.exit(1)
+
+            try:
+                svnfs.contents_cache_bytes = parse_size(svnfs.contents_cache_bytes)
+                svnfs.contents_cache_max_file_size = parse_size(svnfs.contents_cache_max_file_size)
+            except ValueError:
+                sys.stderr.write("Error: Invalid contents memory cache size.\n")
+                sys.exit(1)
+
+            try:
+                svnfs.dir_listings_cache_bytes = parse_size(svnfs.dir_listings_cache_bytes)
+            except ValueError:
+                sys.stderr.write("Error: Invalid directory listings cache size.\n")
+                sys.exit(1)
+
+            try:
+                svnfs.attr_cache_bytes = parse_size(svnfs.attr_cache_bytes)
+            except ValueError:
+                sys.stderr.write("Error: Invalid attributes cache size.\n")
+                sys.exit(1)
+
+            if svnfs.config is not None:
+                # Options from configuration file override mount options.
+                svnfs.config = os.path.abspath(svnfs.config)
+                try:
+                    config_options = read_config_file(svnfs.config)
+                except (IOError, ValueError) as e:
+                    sys.stderr.write("Error: Invalid configuration file: {0}\n".format(str(e)))
+                    sys.exit(1)
+                for name, value in config_options.iteritems():
+                    setattr(svnfs, name, value)
+
+            try:
+                svnfs.warm_max_file_size = parse_size(svnfs.warm_max_file_size)
+            except ValueError:
+                sys.stderr.write("Error: Invalid maximum warmed up file size.\n")
+                sys.exit(1)
+            if svnfs.warm_threads < 1:
+                sys.stderr.write("Error: Number of warm up threads should be positive.\n")
+                sys.exit(1)
+
+            if svnfs.cache_eviction is None:
+                svnfs.cache_eviction = "lru"
+            svnfs.cache_eviction = svnfs.cache_eviction.lower()
+            if svnfs.cache_eviction not in FilesCache.eviction_policies:
+                sys.stderr.write("Error: Invalid cache eviction policy. Should be 'lru' or 'lfu'.\n")
+                sys.exit(1)
+
             # When FUSE daemonizes it changes CWD to root, do it manually.
             os.chdir("/")
 
@@ -793,6 +3185,17 @@ def main():
                     sys.stderr.write("Error: Invalid revision specification. Should be number, 'all' or 'HEAD'.\n")
                     sys.exit(1)
 
+            if svnfs.revision != 'all':
+                # Single revision never changes, so let kernel cache entries
+                # and attributes for long time, unless timeouts are
+                # specified explicitly. In all revisions mode FUSE defaults
+                # are kept, because "/" and "/head" change with each commit
+                # and python-fuse doesn't allow to set timeouts per entry, so
+                # immutable "/NNN/" paths aren't cached longer either.
+                for timeout_option in ("entry_timeout", "attr_timeout", "negative_timeout"):
+                    if timeout_option not in svnfs.fuse_args.optdict:
+                        svnfs.fuse_args.add(timeout_option, str(svnfs.immutable_cache_timeout))
+
             # Open subversion repository before going to FUSE main loop, to handle obvious
             # repository access errors.
             try:
@@ -801,6 +3204,10 @@ def main():
                 sys.stderr.write("Subversion repository opening failed: {0}\n".format(str(e)))
                 sys.exit(1)
 
+            if svnfs.config is not None:
+                svnfs.config_watcher = SignalWatcher(signal.SIGHUP, svnfs.svnfs_reload_config)
+                svnfs.config_watcher.install()
+
     # Flush output before daemonizing
     sys.stdout.flush()
     sys.stderr.flush()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Replay cache accesses trace against repoze_lru cache policies
+
+Trace file contains one accessed key per line. Without trace file synthetic
+trace is used: users access hot working set of entries, while find(1)
+scans large tree, accessing each of its entries once.
+"""
+
+import sys
+import time
+import random
+import argparse
+
+sys.path.append("..")
+import repoze_lru
+
+_marker = object()
+
+
+def synthetic_trace(hot_size, scan_size, seed=0):
+    """Return trace and index at which scan ends"""
+    rnd = random.Random(seed)
+
+    def hot_key():
+        return "hot/{0}".format(rnd.randrange(hot_size))
+
+    trace = [hot_key() for _ in xrange(hot_size * 10)]
+
+    # Scan interleaved with users accesses
+    for i in xrange(scan_size):
+        trace.append("scan/{0}".format(i))
+        if i % 10 == 0:
+            trace.append(hot_key())
+    scan_end = len(trace)
+
+    trace.extend(hot_key() for _ in xrange(hot_size * 10))
+    return trace, scan_end
+
+
+def replay(cache, trace, scan_end):
+    hits = 0
+    hits_after_scan = 0
+    start = time.time()
+    for i, key in enumerate(trace):
+        if cache.get(key, _marker) is _marker:
+            cache.put(key, True)
+        else:
+            hits += 1
+            if i >= scan_end:
+                hits_after_scan += 1
+    elapsed = time.time() - start
+
+    return hits, hits_after_scan, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay cache accesses trace against cache policies")
+    parser.add_argument("trace", nargs="?",
+                        help="file with one accessed key per line [default: synthetic trace]")
+    parser.add_argument("--size", type=int, default=16384,
+                        help="cache size [default: %(default)s]")
+    parser.add_argument("--hot-size", type=int, default=8192,
+                        help="synthetic trace hot working set size [default: %(default)s]")
+    parser.add_argument("--scan-size", type=int, default=200000,
+                        help="synthetic trace scan size [default: %(default)s]")
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = [line.rstrip("\n") for line in f]
+        scan_end = len(trace)
+    else:
+        trace, scan_end = synthetic_trace(args.hot_size, args.scan_size)
+
+    print("{0} accesses, cache size {1}".format(len(trace), args.size))
+    for policy, cache_class in sorted(repoze_lru.lru_cache.policies.items()):
+        hits, hits_after_scan, elapsed = replay(cache_class(args.size), trace, scan_end)
+        line = "{0:>6}: hit ratio {1:.3f}".format(policy, float(hits) / len(trace))
+        if scan_end < len(trace):
+            line += ", after scan {0:.3f}".format(float(hits_after_scan) / (len(trace) - scan_end))
+        line += ", {0:.2f} us per access".format(elapsed / len(trace) * 1e6)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
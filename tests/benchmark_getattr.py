@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""Count Subversion FS calls made by SvnFS per stat() of file
+
+Run from tests directory after test repository is created with
+create_test_repo.sh.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import posixpath
+
+import svn
+import svn.fs
+import svn.core
+import svn.repos
+
+sys.path.append("..")
+import svnfs
+
+counted_functions = ["revision_root", "check_path", "node_id", "node_created_rev",
+                     "file_length", "revision_prop", "dir_entries"]
+
+
+def install_counters():
+    calls = dict((name, 0) for name in counted_functions)
+
+    def make_counter(name, f):
+        def counter(*args):
+            calls[name] += 1
+            return f(*args)
+        return counter
+
+    for name in counted_functions:
+        setattr(svn.fs, name, make_counter(name, getattr(svn.fs, name)))
+
+    return calls
+
+
+def list_paths(repo_path):
+    """Return list of "/<rev>/<path>" for all nodes in all revisions"""
+    pool = svn.core.Pool()
+    fs_ptr = svn.repos.svn_repos_fs(svn.repos.svn_repos_open(repo_path, pool))
+
+    paths = []
+    for rev in xrange(1, svn.fs.youngest_rev(fs_ptr, pool) + 1):
+        root = svn.fs.revision_root(fs_ptr, rev, pool)
+        dirs = ["/"]
+        while dirs:
+            path = dirs.pop()
+            for name, entry in svn.fs.dir_entries(root, path, pool).iteritems():
+                entry_path = posixpath.join(path, name)
+                paths.append("/{0}{1}".format(rev, entry_path))
+                if entry.kind == svn.core.svn_node_dir:
+                    dirs.append(entry_path)
+    return paths
+
+
+def make_svnfs(repo_path, cache_dir):
+    fs = svnfs.SvnFS()
+    fs.repospath = repo_path
+    fs.revision = "all"
+    fs.cache_dir = cache_dir
+    fs.init_repo()
+    return fs
+
+
+def run_pass(title, fs, paths, calls):
+    for name in calls:
+        calls[name] = 0
+
+    for path in paths:
+        fs.getattr(path)
+
+    total = sum(calls.values())
+    print("{0}: {1} stats, {2} FS calls, {3:.2f} calls per stat".format(
+        title, len(paths), total, float(total) / len(paths)))
+    for name in counted_functions:
+        if calls[name]:
+            print("    {0}: {1}".format(name, calls[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count Subversion FS calls per stat")
+    parser.add_argument("repo", nargs="?", default="test_repo",
+                        help="path to Subversion repository [default: %(default)s]")
+    args = parser.parse_args()
+
+    repo_path = os.path.abspath(args.repo)
+    paths = list_paths(repo_path)
+    calls = install_counters()
+
+    cache_dir = tempfile.mkdtemp(prefix="cache_", dir=os.curdir)
+    try:
+        fs = make_svnfs(repo_path, cache_dir)
+        run_pass("Cold", fs, paths, calls)
+        run_pass("Warm", fs, paths, calls)
+        fs.fsdestroy()
+
+        fs = make_svnfs(repo_path, cache_dir)
+        run_pass("Restarted", fs, paths, calls)
+        fs.fsdestroy()
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,17 @@ import os
 import sys
 import time
 import shutil
+import shelve
+import pickle
+import hashlib
 import signal
+import errno
 import tempfile
+import itertools
 import threading
 import subprocess
 import multiprocessing
+from stat import S_ISDIR, S_ISREG
 
 # TODO: check Python version and import unittest2 module, if version is less
 # than 2.7
@@ -17,16 +23,16 @@ import argparse
 
 import svn
 import svn.fs
+import svn.core
 import svn.repos
 
-# TODO: test simultaneous read of big file from many threads
-
 test_repo = "test_repo"
 svnfs_script = "../svnfs.py"
 interactive_mnt = "mnt"
 
 sys.path.append("..")
 import svnfs
+import repoze_lru
 
 
 def is_mounted(directory):
@@ -308,6 +314,41 @@ class TestAllContent(BaseTestAllContent):
         for p in processes:
             p.join()
 
+    def test_list_dir(self):
+        self.assertEqual(sorted(os.listdir(self.mnt)), ["1", "2", "3", "4", "5", "head"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.mnt, "4", "a"))), ["b", "b1", "test.txt"])
+
+    def test_date_revision_dir(self):
+        self.assertEqual(sorted(os.listdir(os.path.join(self.mnt, "@2100-01-01"))),
+                         sorted(os.listdir(os.path.join(self.mnt, "head"))))
+        self.assertFalse(os.path.exists(os.path.join(self.mnt, "@1970-01-01T00:00Z")))
+        self.assertFalse(os.path.exists(os.path.join(self.mnt, "@not-a-date")))
+
+    def test_partial_read(self):
+        with open(os.path.join(self.mnt, "4", "a", "b", "test2.txt"), "r") as f:
+            f.seek(6)
+            self.assertEqual(f.read(6), "change")
+
+    def test_concurrent_read(self):
+        file_path = os.path.join(self.mnt, "5", "file")
+
+        def read_file(file_path, result_queue):
+            with open(file_path, "r") as f:
+                result_queue.put(f.read())
+
+        result_queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=read_file, args=(file_path, result_queue))
+                     for _ in xrange(20)]
+
+        for p in processes:
+            p.start()
+
+        for p in processes:
+            p.join()
+
+        for _ in processes:
+            self.assertEqual(result_queue.get(), "More files\n")
+
     # TODO: test not existing revision
     # TODO: test single revision, and head revision mounting
 
@@ -374,6 +415,924 @@ class TestRevisionEncoding(unittest.TestCase):
         self.assertFalse(encoded.find("..") >= 0)
 
 
+class TestFilesCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="cache_", dir=os.curdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def create_shelve_db(self, node_revision_ids, contents):
+        db = shelve.open(os.path.join(self.cache_dir, "db"), protocol=pickle.HIGHEST_PROTOCOL)
+        db["version"] = 1
+        os.mkdir(os.path.join(self.cache_dir, "cache"))
+        for node_revision_id in node_revision_ids:
+            cache_file = svnfs.encode_node_revision_id(node_revision_id)
+            db[node_revision_id] = dict(cache_file=cache_file)
+            with open(os.path.join(self.cache_dir, "cache", cache_file), "w") as f:
+                f.write(contents)
+        db.close()
+
+    def test_migrate_shelve_db(self):
+        node_revision_ids = ['0-1.0.r2/45', '0-1.0.r3/45']
+        content_key = "sha1-" + hashlib.sha1("Test file\n").hexdigest()
+        self.create_shelve_db(node_revision_ids, "Test file\n")
+
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "db")))
+        # Index is imported before FUSE forks process, it's written without
+        # writer threads.
+        self.assertIsNone(files_cache.cache_db.writer_thread)
+        self.assertIsNone(files_cache.nodes_db.writer_thread)
+        files_cache.close()
+
+        # Files are served by old names until they are migrated
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        for node_revision_id in node_revision_ids:
+            legacy_key = files_cache.get_content_key(node_revision_id)
+            self.assertEqual(legacy_key, svnfs.encode_node_revision_id(node_revision_id))
+            self.assertEqual(files_cache.get_file_path(legacy_key),
+                             os.path.join(self.cache_dir, "cache", legacy_key))
+        self.assertTrue(files_cache.check_integrity())
+
+        total_size = files_cache.total_size
+        files_cache.migrate_legacy_files()
+        for node_revision_id in node_revision_ids:
+            self.assertEqual(files_cache.get_content_key(node_revision_id), content_key)
+        self.assertEqual(files_cache.get_file_path(content_key),
+                         os.path.join(self.cache_dir, "cache", svnfs.sharded_cache_file(content_key)))
+        self.assertTrue(files_cache.check_integrity())
+        # Duplicate is removed
+        self.assertEqual(files_cache.total_size, total_size - len("Test file\n"))
+
+        files_cache.close()
+
+    def test_migrate_resolved_content_key(self):
+        # MD5 is used for representations without stored SHA-1
+        content_key = "md5-" + hashlib.md5("Test file\n").hexdigest()
+        self.create_shelve_db(['0-1.0.r2/45', '0-1.0.r3/45'], "Test file\n")
+
+        resolved = {'0-1.0.r2/45': content_key}
+        files_cache = svnfs.FilesCache(self.cache_dir, resolve_content_key=resolved.get)
+        files_cache.migrate_legacy_files()
+
+        self.assertEqual(files_cache.get_content_key('0-1.0.r2/45'), content_key)
+        # Not found node revision is dropped
+        self.assertIsNone(files_cache.get_content_key('0-1.0.r3/45'))
+        self.assertTrue(files_cache.check_integrity())
+        self.assertEqual(files_cache.get_file_path(content_key),
+                         os.path.join(self.cache_dir, "cache", svnfs.sharded_cache_file(content_key)))
+
+        files_cache.close()
+
+    def test_migrate_layout(self):
+        content_key = "sha1-" + hashlib.sha1("Test file\n").hexdigest()
+
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        with open(os.path.join(self.cache_dir, "cache", content_key), "w") as f:
+            f.write("Test file\n")
+        files_cache.cache_db.put(content_key, dict(cache_file=content_key, size=10,
+                                                   last_access=time.time(), accesses=0))
+
+        files_cache.migrate_layout()
+        self.assertTrue(files_cache.check_integrity())
+
+        cache_file = files_cache.get_file_path(content_key)
+        self.assertEqual(cache_file,
+                         os.path.join(self.cache_dir, "cache", svnfs.sharded_cache_file(content_key)))
+        with open(cache_file) as f:
+            self.assertEqual(f.read(), "Test file\n")
+
+        files_cache.close()
+
+    def test_fix_integrity(self):
+        valid_key = "sha1-" + hashlib.sha1("Test file\n").hexdigest()
+        broken_key = "sha1-" + hashlib.sha1("First change\n").hexdigest()
+        missing_key = "sha1-" + hashlib.sha1("More files\n").hexdigest()
+
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        for content_key, contents in [(valid_key, "Test file\n"), (broken_key, "Broken\n")]:
+            full_path = os.path.join(self.cache_dir, "cache", svnfs.sharded_cache_file(content_key))
+            os.makedirs(os.path.dirname(full_path))
+            with open(full_path, "w") as f:
+                f.write(contents)
+        files_cache.cache_db.put(missing_key, dict(cache_file=svnfs.sharded_cache_file(missing_key),
+                                                   size=11, last_access=time.time(), accesses=0))
+        self.assertFalse(files_cache.check_integrity())
+
+        files_cache.fix_integrity()
+        self.assertTrue(files_cache.check_integrity())
+        self.assertIsNotNone(files_cache.get_file_path(valid_key))
+        self.assertIsNone(files_cache.get_file_path(broken_key))
+        self.assertIsNone(files_cache.get_file_path(missing_key))
+
+        files_cache.close()
+
+    def test_empty_file(self):
+        content_key = "sha1-" + hashlib.sha1("").hexdigest()
+
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        # Retrieval isn't run yet, so partial file doesn't exist
+        retrieval = svnfs.FileRetrieval(content_key, 0, os.path.join(files_cache.cache_temp_dir, content_key),
+                                        lambda offset: iter([]))
+        self.assertEqual(retrieval.read(4096, 0), "")
+
+        self.assertEqual(files_cache.read_file(content_key, 0, lambda offset: iter([]), 4096, 0), "")
+        # Wait until retrieval is finished
+        for i in xrange(100):
+            cache_file = files_cache.get_file_path(content_key)
+            if cache_file is not None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.path.getsize(cache_file), 0)
+        self.assertEqual(files_cache.read_file(content_key, 0, lambda offset: iter([]), 4096, 0), "")
+
+        files_cache.close()
+
+    def test_compressed_file(self):
+        contents = "".join("Line {0}\n".format(i) for i in xrange(100000))
+        content_key = "sha1-" + hashlib.sha1(contents).hexdigest()
+
+        files_cache = svnfs.FilesCache(self.cache_dir, compression=True)
+        data = files_cache.read_file(content_key, len(contents), lambda offset: iter([contents[offset:]]),
+                                     100, 200000)
+        self.assertEqual(data, contents[200000:200100])
+
+        # Wait until retrieval is finished
+        for i in xrange(100):
+            cache_file = files_cache.get_file_path(content_key)
+            if cache_file is not None:
+                break
+            time.sleep(0.1)
+        self.assertTrue(cache_file.endswith(svnfs.compressed_file_suffix))
+        self.assertLess(os.path.getsize(cache_file), len(contents))
+
+        reader = files_cache.open_file(content_key)
+        self.assertEqual(reader.read(len(contents), 0), contents)
+        self.assertEqual(reader.read(len(contents), 600000), contents[600000:])
+        reader.close()
+
+        files_cache.cache_db.delete(content_key)
+        files_cache.build_db_from_cache()
+        self.assertEqual(files_cache.get_file_path(content_key), cache_file)
+
+        files_cache.close()
+
+    def put_file(self, files_cache, contents):
+        content_key = "sha1-" + hashlib.sha1(contents).hexdigest()
+        temp_file_path = os.path.join(files_cache.cache_temp_dir, content_key)
+        with open(temp_file_path, "w") as f:
+            f.write(contents)
+        files_cache.put_file(content_key, temp_file_path)
+        return content_key
+
+    def test_evict_lru(self):
+        files_cache = svnfs.FilesCache(self.cache_dir, max_bytes=100)
+        content_keys = []
+        for i in range(10):
+            content_keys.append(self.put_file(files_cache, "{0:010d}".format(i)))
+            files_cache.cache_db.get(content_keys[-1])["last_access"] = i
+        files_cache.touch(content_keys[0])
+        self.assertEqual(files_cache.total_size, 100)
+
+        # Opened and being retrieved files aren't evicted
+        files_cache.pin(content_keys[1])
+        files_cache.in_flight[content_keys[2]] = None
+
+        content_keys.append(self.put_file(files_cache, "{0:010d}".format(10)))
+        self.assertTrue(files_cache.janitor_event.is_set())
+        files_cache.clean_up()
+
+        self.assertEqual(files_cache.total_size, 90)
+        self.assertEqual(files_cache.evictions, 2)
+        evicted = [content_key for content_key in content_keys if files_cache.get_file_path(content_key) is None]
+        self.assertEqual(evicted, content_keys[3:5])
+        for content_key in evicted:
+            self.assertFalse(os.path.exists(os.path.join(files_cache.cache_files_dir,
+                                                         svnfs.sharded_cache_file(content_key))))
+        self.assertTrue(files_cache.check_integrity())
+
+        files_cache.unpin(content_keys[1])
+        del files_cache.in_flight[content_keys[2]]
+        files_cache.close()
+
+    def test_evict_lfu(self):
+        files_cache = svnfs.FilesCache(self.cache_dir, eviction_policy="lfu")
+        content_keys = []
+        for i in range(10):
+            content_keys.append(self.put_file(files_cache, "{0:010d}".format(i)))
+            entry = files_cache.cache_db.get(content_keys[-1])
+            entry["accesses"] = i % 3 + 1
+            entry["last_access"] = i
+
+        # Least recently used of equally used files are evicted first
+        files_cache.evict(70)
+        self.assertEqual(files_cache.total_size, 70)
+        evicted = [content_key for content_key in content_keys if files_cache.get_file_path(content_key) is None]
+        self.assertEqual(evicted, [content_keys[0], content_keys[3], content_keys[6]])
+
+        files_cache.close()
+
+    def test_persistent_metadata(self):
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        files_cache.put_metadata('0-1.0.r2/45', dict(mtime=1000000000, size=13))
+        files_cache.close()
+
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        self.assertEqual(files_cache.get_metadata('0-1.0.r2/45'), dict(mtime=1000000000, size=13))
+        self.assertIsNone(files_cache.get_metadata('0-1.0.r3/45'))
+        # Only looked up entries are kept in memory
+        self.assertEqual(files_cache.metadata_cache.data.keys(), ['0-1.0.r2/45'])
+        self.assertEqual(len(files_cache.metadata_db), 1)
+
+        files_cache.close()
+
+    def test_prune_content_keys(self):
+        files_cache = svnfs.FilesCache(self.cache_dir, metadata_max_entries=10)
+        for rev in range(20):
+            files_cache.put_content_key('0-1.0.r{0}/45'.format(rev), "sha1-{0:040d}".format(rev))
+            if rev == 9:
+                files_cache.flush()
+        files_cache.close()
+
+        files_cache = svnfs.FilesCache(self.cache_dir, metadata_max_entries=10)
+        # Only looked up entries are kept in memory
+        self.assertEqual(files_cache.get_content_key('0-1.0.r19/45'), "sha1-{0:040d}".format(19))
+        self.assertEqual(files_cache.content_keys_cache.data.keys(), ['0-1.0.r19/45'])
+
+        files_cache.prune_metadata()
+        self.assertEqual(files_cache.pruned_metadata, 11)
+        self.assertEqual(len(files_cache.nodes_db), 9)
+        for rev in range(10):
+            self.assertIsNone(files_cache.get_content_key('0-1.0.r{0}/45'.format(rev)))
+
+        files_cache.close()
+
+    def test_writer_thread_after_fork(self):
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        files_cache.put_metadata('0-1.0.r2/45', dict(mtime=1000000000, size=13))
+        writer_thread = files_cache.metadata_db.writer_thread
+
+        # Forked process doesn't have writer thread started by parent
+        files_cache.metadata_db.writer_pid = None
+        files_cache.put_metadata('0-1.0.r3/45', dict(mtime=1000000000, size=13))
+        self.assertIsNot(files_cache.metadata_db.writer_thread, writer_thread)
+        self.assertEqual(files_cache.metadata_db.writer_pid, os.getpid())
+
+        # Changes are written without flush()
+        for i in xrange(100):
+            if len(files_cache.metadata_db) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(files_cache.metadata_db), 2)
+
+        files_cache.close()
+        self.assertFalse(files_cache.metadata_db.writer_thread.is_alive())
+
+    def test_metadata_front_cache_budget(self):
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        files_cache.metadata_cache.resize(100, 4 * svnfs.attr_cache_entry_size)
+        for rev in range(10):
+            files_cache.put_metadata('0-1.0.r{0}/45'.format(rev), dict(mtime=1000000000, size=rev))
+        self.assertEqual(files_cache.metadata_cache.total_bytes, 4 * svnfs.attr_cache_entry_size)
+
+        # Evicted entries are looked up in database
+        for rev in range(10):
+            self.assertEqual(files_cache.get_metadata('0-1.0.r{0}/45'.format(rev)), dict(mtime=1000000000, size=rev))
+
+        files_cache.close()
+
+    def test_prune_metadata(self):
+        files_cache = svnfs.FilesCache(self.cache_dir, metadata_max_entries=10)
+        for rev in range(20):
+            files_cache.put_metadata('0-1.0.r{0}/45'.format(rev), dict(mtime=1000000000, size=rev))
+            if rev == 9:
+                files_cache.flush()
+        files_cache.close()
+
+        files_cache.prune_metadata()
+        self.assertEqual(files_cache.pruned_metadata, 11)
+        self.assertEqual(len(files_cache.metadata_db), 9)
+
+        # Entries written earlier are pruned first
+        files_cache = svnfs.FilesCache(self.cache_dir)
+        for rev in range(10):
+            self.assertIsNone(files_cache.get_metadata('0-1.0.r{0}/45'.format(rev)))
+
+        files_cache.close()
+
+
+class TestRevisionDates(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="cache_", dir=os.curdir)
+        self.path = os.path.join(self.cache_dir, "revision_dates")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_persistence(self):
+        read_revs = []
+
+        def read_date(rev):
+            read_revs.append(rev)
+            return 1000000000.0 + rev
+
+        revision_dates = svnfs.RevisionDates(self.path, "uuid", read_date)
+        revision_dates.fill(3)
+        self.assertEqual(revision_dates.get(2), 1000000002.0)
+
+        revision_dates = svnfs.RevisionDates(self.path, "uuid", read_date)
+        revision_dates.fill(5)
+        self.assertEqual(read_revs, [0, 1, 2, 3, 4, 5])
+        self.assertEqual(revision_dates.get(5), 1000000005.0)
+
+        # Not indexed yet
+        self.assertEqual(revision_dates.get(6), 1000000006.0)
+
+        # Index of other repository is ignored
+        revision_dates = svnfs.RevisionDates(self.path, "other-uuid", read_date)
+        self.assertEqual(len(revision_dates.dates), 0)
+
+
+class TestPathHistoryIndex(unittest.TestCase):
+    def test_canonical_rev(self):
+        changes = {
+            1: [("/trunk", svn.fs.path_change_add), ("/trunk/a.txt", svn.fs.path_change_add),
+                ("/trunk/b.txt", svn.fs.path_change_add)],
+            2: [("/trunk/a.txt", svn.fs.path_change_modify)],
+            3: [("/other.txt", svn.fs.path_change_add)],
+            4: [("/trunk", svn.fs.path_change_replace)],
+        }
+        index = svnfs.PathHistoryIndex(changes.get)
+        index.fill(4)
+
+        self.assertEqual(index.canonical_rev("/trunk/a.txt", 3), 2)
+        self.assertEqual(index.canonical_rev("/trunk/b.txt", 3), 1)
+        self.assertEqual(index.canonical_rev("/trunk", 3), 2)
+        self.assertEqual(index.canonical_rev("/", 3), 3)
+        # Replaced parent directory
+        self.assertEqual(index.canonical_rev("/trunk/b.txt", 4), 4)
+        # Never existed path
+        self.assertEqual(index.canonical_rev("/missing.txt", 3), 3)
+        # Not indexed revision
+        self.assertEqual(index.canonical_rev("/trunk/b.txt", 5), 5)
+
+
+class TestFileWatcher(unittest.TestCase):
+    def setUp(self):
+        self.watched_dir = tempfile.mkdtemp(prefix="watch_", dir=os.curdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.watched_dir)
+
+    def test_replaced_file(self):
+        file_path = os.path.join(self.watched_dir, "current")
+        with open(file_path, "w") as f:
+            f.write("1\n")
+
+        changed = threading.Event()
+        watcher = svnfs.FileWatcher(file_path, changed.set)
+        self.assertTrue(watcher.start())
+
+        with open(os.path.join(self.watched_dir, "other"), "w") as f:
+            f.write("other\n")
+        changed.wait(0.2)
+        self.assertFalse(changed.is_set())
+
+        # Subversion replaces db/current by renaming new file over it
+        with open(file_path + ".tmp", "w") as f:
+            f.write("2\n")
+        os.rename(file_path + ".tmp", file_path)
+        changed.wait(5)
+        self.assertTrue(changed.is_set())
+
+    def test_read_error(self):
+        file_path = os.path.join(self.watched_dir, "current")
+        with open(file_path, "w") as f:
+            f.write("1\n")
+
+        # Interrupted read is retried, other errors stop watching
+        errors = [OSError(errno.EINTR, os.strerror(errno.EINTR)), OSError(errno.EIO, os.strerror(errno.EIO))]
+        original_read = os.read
+        test_thread = threading.current_thread()
+
+        def failing_read(fd, size):
+            if errors and threading.current_thread() is not test_thread:
+                raise errors.pop(0)
+            return original_read(fd, size)
+
+        changed = threading.Event()
+        stopped = threading.Event()
+        watcher = svnfs.FileWatcher(file_path, changed.set, stopped.set)
+        os.read = failing_read
+        try:
+            self.assertTrue(watcher.start())
+            stopped.wait(5)
+        finally:
+            os.read = original_read
+
+        self.assertTrue(stopped.is_set())
+        self.assertEqual(errors, [])
+        self.assertFalse(changed.is_set())
+        self.assertIsNone(watcher.fd)
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp(prefix="config_", dir=os.curdir)
+        self.config_path = os.path.join(self.config_dir, "svnfs.conf")
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def write_config(self, text):
+        with open(self.config_path, "w") as f:
+            f.write(text)
+
+    def test_read_config_file(self):
+        self.write_config("# Memory budget\n"
+                          "attr_cache_bytes = 8M\n"
+                          "\n"
+                          "dir_listings_cache_bytes=512K\n")
+        self.assertEqual(svnfs.read_config_file(self.config_path),
+                         {"attr_cache_bytes": 8 * 1024 ** 2, "dir_listings_cache_bytes": 512 * 1024})
+
+        self.write_config("revision = 1\n")
+        self.assertRaises(ValueError, svnfs.read_config_file, self.config_path)
+        self.write_config("attr_cache_bytes = many\n")
+        self.assertRaises(ValueError, svnfs.read_config_file, self.config_path)
+
+    def test_reload_on_sighup(self):
+        old_handler = signal.getsignal(signal.SIGHUP)
+        reloaded = threading.Event()
+        watcher = svnfs.SignalWatcher(signal.SIGHUP, reloaded.set)
+        try:
+            watcher.install()
+            watcher.start()
+            os.kill(os.getpid(), signal.SIGHUP)
+            reloaded.wait(5)
+            self.assertTrue(reloaded.is_set())
+        finally:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGHUP, old_handler)
+
+
+class TestCachesMaxBytes(unittest.TestCase):
+    cache_classes = [repoze_lru.LRUCache, repoze_lru.SLRUCache, repoze_lru.ExpiringLRUCache]
+
+    def make_caches(self, size, max_bytes):
+        return [cache_class(size, max_bytes=max_bytes) for cache_class in self.cache_classes]
+
+    def cached_bytes(self, cache, keys):
+        return sum(len(cache.get(key, "")) for key in keys)
+
+    def test_total_bytes(self):
+        for cache in self.make_caches(10, 100):
+            cache.put("a", "x" * 10)
+            cache.put("b", "x" * 20)
+            self.assertEqual(cache.total_bytes, 30)
+
+            cache.put("a", "x" * 5)
+            self.assertEqual(cache.get("a"), "x" * 5)
+            self.assertEqual(cache.total_bytes, 25)
+
+            cache.invalidate("b")
+            cache.invalidate("b")
+            self.assertEqual(cache.total_bytes, 5)
+
+            # Entries are evicted to fit new ones
+            for i in range(5):
+                cache.put(i, "x" * 30)
+            self.assertLessEqual(cache.total_bytes, 100)
+            self.assertEqual(cache.total_bytes, self.cached_bytes(cache, ["a", "b"] + range(5)))
+
+    def test_resize_length(self):
+        for cache in self.make_caches(10, 1000):
+            for i in range(10):
+                cache.put(i, "x" * 10)
+
+            cache.resize(4)
+            self.assertEqual(cache.total_bytes, 40)
+            self.assertEqual(self.cached_bytes(cache, range(10)), 40)
+
+            cache.put("a", "x" * 10)
+            self.assertEqual(cache.total_bytes, 40)
+            self.assertEqual(self.cached_bytes(cache, ["a"] + range(10)), 40)
+
+    def test_resize_bytes(self):
+        for cache in self.make_caches(10, 1000):
+            for i in range(10):
+                cache.put(i, "x" * 10)
+
+            cache.resize(max_bytes=35)
+            self.assertEqual(cache.total_bytes, 30)
+            self.assertEqual(self.cached_bytes(cache, range(10)), 30)
+
+            cache.put("a", "x" * 30)
+            self.assertLessEqual(cache.total_bytes, 35)
+            self.assertEqual(cache.total_bytes, self.cached_bytes(cache, ["a"] + range(10)))
+
+    def test_zero_max_bytes(self):
+        for cache in self.make_caches(10, 0):
+            cache.put("a", "x")
+            self.assertIsNone(cache.get("a"))
+            cache.put("b", "")
+            self.assertEqual(cache.get("b"), "")
+            self.assertEqual(cache.total_bytes, 0)
+
+        # Cache is emptied by resizing to zero bytes
+        for cache in self.make_caches(10, 100):
+            cache.put("a", "x")
+            cache.resize(1, 0)
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.total_bytes, 0)
+
+    def test_value_larger_than_max_bytes(self):
+        for cache in self.make_caches(10, 10):
+            cache.put("a", "x" * 5)
+            cache.put("b", "x" * 11)
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), "x" * 5)
+            self.assertEqual(cache.total_bytes, 5)
+
+            # Previous value isn't kept
+            cache.put("a", "x" * 11)
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.total_bytes, 0)
+
+
+class TestSLRUCache(unittest.TestCase):
+    def test_scan_resistance(self):
+        cache = repoze_lru.SLRUCache(10)
+        hot_keys = ["hot%d" % i for i in xrange(4)]
+        for key in hot_keys:
+            cache.put(key, key)
+            cache.get(key)
+        self.assertEqual(list(cache.protected), hot_keys)
+
+        # Scan doesn't fit into remaining probationary segment
+        scan_keys = ["scan%d" % i for i in xrange(20)]
+        for key in scan_keys:
+            cache.put(key, key)
+
+        self.assertEqual(list(cache.protected), hot_keys)
+        self.assertEqual(list(cache.probation), scan_keys[-6:])
+        for key in hot_keys:
+            self.assertEqual(cache.get(key), key)
+        self.assertEqual(cache.evictions, 14)
+
+    def test_demotion(self):
+        cache = repoze_lru.SLRUCache(10)
+        keys = ["k%d" % i for i in xrange(9)]
+        for key in keys:
+            cache.put(key, key)
+            cache.get(key)
+
+        # Least recently used entry of full protected segment is demoted
+        self.assertEqual(list(cache.protected), keys[1:])
+        self.assertEqual(list(cache.probation), ["k0"])
+
+        # Demoted entry is promoted back on access
+        self.assertEqual(cache.get("k0"), "k0")
+        self.assertEqual(list(cache.protected), keys[2:] + ["k0"])
+        self.assertEqual(list(cache.probation), ["k1"])
+
+        # and is evicted before protected entries otherwise
+        cache.put("new0", "new0")
+        cache.put("new1", "new1")
+        self.assertEqual(list(cache.probation), ["new0", "new1"])
+        self.assertEqual(list(cache.protected), keys[2:] + ["k0"])
+        self.assertIsNone(cache.get("k1"))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_misses(self):
+        calls = []
+        release = threading.Event()
+
+        @repoze_lru.lru_cache(16, single_flight=True)
+        def compute(key):
+            calls.append(key)
+            release.wait(5)
+            if key == "bad":
+                raise ValueError(key)
+            return key * 2
+
+        for key, expected in (("a", "aa"), ("bad", ValueError)):
+            release.clear()
+            results = []
+
+            def call():
+                try:
+                    results.append(compute(key))
+                except ValueError as e:
+                    results.append(type(e))
+
+            threads = [threading.Thread(target=call) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(calls.count(key), 1)
+            self.assertEqual(results, [expected] * 8)
+
+    def test_finished_before_registration(self):
+        class RacingCache(repoze_lru.LRUCache):
+            def get(self, key, default=None):
+                val = super(RacingCache, self).get(key, default)
+                if self.lookups == 1:
+                    # Another leader finishes just after first lookup
+                    self.put(key, "cached")
+                return val
+
+        calls = []
+
+        @repoze_lru.lru_cache(16, cache=RacingCache(16), single_flight=True)
+        def compute(key):
+            calls.append(key)
+            return key * 2
+
+        self.assertEqual(compute("a"), "cached")
+        self.assertEqual(calls, [])
+
+    def test_stale_while_revalidate(self):
+        values = iter(["old", "new"])
+        entered = threading.Event()
+        release = threading.Event()
+
+        @repoze_lru.lru_cache(1, timeout=0.1, stale_while_revalidate=60)
+        def compute():
+            value = next(values)
+            if value == "new":
+                entered.set()
+                release.wait(5)
+            return value
+
+        self.assertEqual(compute(), "old")
+        time.sleep(0.2)
+
+        results = []
+        refresher = threading.Thread(target=lambda: results.append(compute()))
+        refresher.start()
+        entered.wait(5)
+        # Entry is recomputed, so expired value is returned without waiting
+        self.assertEqual(compute(), "old")
+        release.set()
+        refresher.join()
+        self.assertEqual(results, ["new"])
+        self.assertEqual(compute(), "new")
+
+
+class BaseTestSvnFS(unittest.TestCase):
+    """Test SvnFS methods called directly, without mounting
+
+    Calls of svn.fs functions listed in counted_functions are counted in
+    self.calls.
+    """
+    counted_functions = []
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="cache_", dir=os.curdir)
+
+        self.calls = dict((name, 0) for name in self.counted_functions)
+        self.original_functions = {}
+        for name in self.counted_functions:
+            self.original_functions[name] = getattr(svn.fs, name)
+            setattr(svn.fs, name, self.make_counter(name, self.original_functions[name]))
+
+    def tearDown(self):
+        for name, function in self.original_functions.iteritems():
+            setattr(svn.fs, name, function)
+        shutil.rmtree(self.cache_dir)
+
+    def make_counter(self, name, function):
+        def counter(*args):
+            self.calls[name] += 1
+            return function(*args)
+        return counter
+
+    def wait_cached(self, files_cache, content_key):
+        """Wait until retrieval is finished, return path of cached file"""
+        for i in xrange(100):
+            cache_file = files_cache.get_file_path(content_key)
+            if cache_file is not None:
+                return cache_file
+            time.sleep(0.1)
+        return None
+
+    def make_svnfs(self, **options):
+        fs = svnfs.SvnFS()
+        fs.repospath = os.path.abspath(test_repo)
+        fs.revision = "all"
+        fs.cache_dir = self.cache_dir
+        for name, value in options.iteritems():
+            setattr(fs, name, value)
+        fs.init_repo()
+        return fs
+
+
+class TestLegacyCacheMigration(BaseTestSvnFS):
+    def test_content_key(self):
+        fs = self.make_svnfs()
+        node_revision_id = fs.svnfs_lookup_node(2, "/test.txt")[1]
+        content_key = fs.svnfs_content_key(2, "/test.txt", node_revision_id, svn.core.Pool())
+        fs.fsdestroy()
+        shutil.rmtree(self.cache_dir)
+
+        # Cache of version 1 with the same node revision
+        os.makedirs(os.path.join(self.cache_dir, "cache"))
+        db = shelve.open(os.path.join(self.cache_dir, "db"), protocol=pickle.HIGHEST_PROTOCOL)
+        db["version"] = 1
+        cache_file = svnfs.encode_node_revision_id(node_revision_id)
+        db[node_revision_id] = dict(cache_file=cache_file)
+        with open(os.path.join(self.cache_dir, "cache", cache_file), "w") as f:
+            f.write("First change\n")
+        db.close()
+
+        fs = self.make_svnfs()
+        fs.files_cache.migrate_legacy_files()
+        self.assertEqual(fs.files_cache.get_content_key(node_revision_id), content_key)
+        self.assertIsNotNone(fs.files_cache.get_file_path(content_key))
+
+        fs.fsdestroy()
+
+
+class TestFileHandle(BaseTestSvnFS):
+    def test_cache_file_access_statistics(self):
+        fs = self.make_svnfs(contents_cache_bytes=0)
+        f = fs.file_class("/4/a/test.txt", os.O_RDONLY)
+        contents = f.read(f.size, 0)
+        self.assertIsNotNone(self.wait_cached(fs.files_cache, f.content_key))
+        entry = fs.files_cache.cache_db.get(f.content_key)
+        accesses = entry["accesses"]
+
+        # Cache file is opened by handle, it's counted as access
+        self.assertEqual(f.read(4, 0), contents[:4])
+        self.assertIsNotNone(f.cache_reader)
+        self.assertEqual(entry["accesses"], accesses + 1)
+
+        # Following reads only update access time
+        entry["last_access"] = 0
+        fs.files_cache.touched.clear()
+        self.assertEqual(f.read(f.size, 4), contents[4:])
+        self.assertEqual(entry["accesses"], accesses + 1)
+        self.assertGreater(entry["last_access"], 0)
+        self.assertIn(f.content_key, fs.files_cache.touched)
+
+        f.release(os.O_RDONLY)
+        self.assertIsNone(f.cache_reader)
+        self.assertNotIn(f.content_key, fs.files_cache.pins)
+
+        fs.fsdestroy()
+
+
+class TestReaddir(BaseTestSvnFS):
+    counted_functions = ["dir_entries"]
+
+    def test_paging_huge_directory(self):
+        # Listing doesn't fit into listings cache
+        fs = self.make_svnfs(dir_listings_cache_bytes=1)
+
+        path = "/4/a/b"
+        dir_handle = fs.opendir(path)
+        names = []
+        offset = 0
+        while True:
+            page = list(itertools.islice(fs.readdir(path, offset, dir_handle), 2))
+            if not page:
+                break
+            names.extend(entry.name for entry in page)
+            offset = page[-1].offset
+        fs.releasedir(path, dir_handle)
+
+        self.assertEqual(names, [".", "..", "c", "test.txt", "test2.txt"])
+        self.assertEqual(self.calls["dir_entries"], 1)
+
+        fs.fsdestroy()
+
+
+class TestPrefillAttributes(BaseTestSvnFS):
+    counted_functions = ["check_path", "node_id", "file_length"]
+
+    def test_cold_directory(self):
+        fs = self.make_svnfs()
+        self.assertEqual(sorted(entry.name for entry in fs.readdir("/4/a/b", 0)),
+                         [".", "..", "c", "test.txt", "test2.txt"])
+        self.assertEqual(self.calls["file_length"], 2)
+
+        for name in self.calls:
+            self.calls[name] = 0
+        st = fs.getattr("/4/a/b/test2.txt")
+        self.assertEqual(st.st_size, len("First change\n"))
+        self.assertTrue(S_ISREG(st.st_mode))
+        self.assertTrue(S_ISDIR(fs.getattr("/4/a/b/c").st_mode))
+        self.assertEqual(self.calls, dict(check_path=0, node_id=0, file_length=0))
+
+        fs.fsdestroy()
+
+
+class TestNegativeLookups(BaseTestSvnFS):
+    counted_functions = ["check_path"]
+
+    def assertNotFound(self, fs, path):
+        with self.assertRaises(OSError) as cm:
+            fs.getattr(path)
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+
+    def test_repeated_miss(self):
+        fs = self.make_svnfs()
+
+        self.assertNotFound(fs, "/2/missing.txt")
+        self.assertEqual(self.calls["check_path"], 1)
+        self.assertEqual(fs.negative_lookups_absorbed, 0)
+
+        self.assertNotFound(fs, "/2/missing.txt")
+        self.assertEqual(self.calls["check_path"], 1)
+        self.assertEqual(fs.negative_lookups_absorbed, 1)
+
+        fs.fsdestroy()
+
+    def test_missing_parent(self):
+        fs = self.make_svnfs()
+
+        self.assertNotFound(fs, "/2/missing")
+        calls = self.calls["check_path"]
+        self.assertNotFound(fs, "/2/missing/test.txt")
+        self.assertEqual(self.calls["check_path"], calls)
+        self.assertEqual(fs.negative_lookups_absorbed, 1)
+
+        fs.fsdestroy()
+
+    def test_head_changed(self):
+        fs = self.make_svnfs()
+
+        # "/a/test.txt" is added in revision 4
+        fs.watched_youngest_rev = 3
+        self.assertNotFound(fs, "/head/a/test.txt")
+        self.assertNotFound(fs, "/head/a/test.txt")
+        self.assertEqual(fs.negative_lookups_absorbed, 1)
+
+        fs.watched_youngest_rev = 4
+        self.assertEqual(fs.getattr("/head/a/test.txt").st_size, len("First change\n"))
+
+        fs.fsdestroy()
+
+
+class TestRevisionsWarmer(BaseTestSvnFS):
+    def queued_paths(self, warmer):
+        paths = []
+        while not warmer.queue.empty():
+            paths.append(warmer.queue.get())
+        return paths
+
+    def test_dispatch_revision(self):
+        fs = self.make_svnfs()
+        warmer = svnfs.RevisionsWarmer(fs)
+
+        # Parent directories are queued before their children
+        warmer.dispatch_revision(4)
+        self.assertEqual(self.queued_paths(warmer),
+                         [(4, "/"), (4, "/a"), (4, "/a/b"), (4, "/a/b/test.txt"),
+                          (4, "/a/b/test2.txt"), (4, "/a/test.txt")])
+
+        fs.fsdestroy()
+
+    def test_prefix(self):
+        fs = self.make_svnfs()
+        warmer = svnfs.RevisionsWarmer(fs, prefix="/a/b/")
+
+        warmer.dispatch_revision(4)
+        self.assertEqual(self.queued_paths(warmer),
+                         [(4, "/"), (4, "/a"), (4, "/a/b"), (4, "/a/b/test.txt"), (4, "/a/b/test2.txt")])
+
+        warmer.dispatch_revision(5)
+        self.assertEqual(self.queued_paths(warmer), [])
+
+        fs.fsdestroy()
+
+    def test_max_file_size(self):
+        fs = self.make_svnfs()
+        content_key = fs.svnfs_content_key(5, "/file", fs.svnfs_lookup_node(5, "/file")[1],
+                                           svn.core.Pool())
+
+        # "/file" is 11 bytes long
+        warmer = svnfs.RevisionsWarmer(fs, max_file_size=10)
+        warmer.warm_path(5, "/file")
+        self.assertEqual((warmer.warmed_paths, warmer.warmed_files), (1, 0))
+        self.assertEqual(fs.files_cache.in_flight, {})
+        self.assertIsNone(fs.files_cache.get_file_path(content_key))
+
+        warmer = svnfs.RevisionsWarmer(fs, max_file_size=11)
+        warmer.warm_path(5, "/file")
+        self.assertEqual((warmer.warmed_paths, warmer.warmed_files), (1, 1))
+        self.assertIsNotNone(self.wait_cached(fs.files_cache, content_key))
+
+        fs.fsdestroy()
+
+
 def run_mount():
     """Mount test repository for interactive testing"""
 